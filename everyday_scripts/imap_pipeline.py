@@ -0,0 +1,319 @@
+"""
+An IMAP client that pipelines commands, for imap_tools.
+
+imaplib waits for the completion of every command before sending the next one, so a single connection spends most of
+its time waiting for round trips. This client sends tagged commands as soon as they are issued, up to a configurable
+depth, and parses the responses as they stream in, reading literals straight off the connection.
+
+The protocol runs on trio, in a background thread. PipelinedIMAP4 wraps it in the subset of the imaplib.IMAP4
+interface that imap_tools uses, returning data in the same shapes, so that it can be shared by the threads of a
+ConnectionPool: each thread calling it concurrently puts another command in flight.
+
+Servers may process pipelined commands concurrently and complete them in any order (RFC 3501, section 5.5), and
+untagged responses carry no tag. Only UID FETCH and UID STORE are pipelined, because every FETCH response they cause
+includes the UID of its message (section 6.4.8): it goes to the command in flight whose message set contains that UID.
+A command for messages that a command in flight is also for waits for it to complete first.
+Any other command, like SEARCH, waits for the commands in flight to complete and runs alone, so that all untagged
+responses until its completion are its own.
+"""
+
+import imaplib
+import logging
+import math
+import re
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import trio
+
+logger = logging.getLogger(__name__)
+
+# Commands in flight on one connection
+PIPELINE_DEPTH = 8
+RECEIVE_SIZE = 65536
+# Commands whose untagged responses can be told apart by UID
+PIPELINED_COMMANDS = ("FETCH", "STORE")
+UID_RE = re.compile(rb"\bUID (\d+)", re.IGNORECASE)
+# The response grammar of imaplib, which typeshed doesn't declare
+UNTAGGED_RESPONSE_RE: re.Pattern[bytes] = imaplib.Untagged_response  # type: ignore[attr-defined]
+UNTAGGED_STATUS_RE: re.Pattern[bytes] = imaplib.Untagged_status  # type: ignore[attr-defined]
+LITERAL_RE: re.Pattern[bytes] = imaplib.Literal  # type: ignore[attr-defined]
+RESPONSE_CODE_RE: re.Pattern[bytes] = imaplib.Response_code  # type: ignore[attr-defined]
+
+Untagged = Dict[str, List[Any]]
+
+
+def quote(arg: str) -> str:
+    """Quote a string argument for an IMAP command."""
+    return '"' + arg.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def uid_ranges(message_set: str) -> List[Tuple[float, float]]:
+    """(low, high) UID ranges of a message set, * being the highest UID of the mailbox
+
+    >>> uid_ranges("1:3,7,9:*")
+    [(1, 3), (7, 7), (9, inf)]
+    """
+    ranges = []
+    for part in message_set.split(","):
+        start, _, end = part.partition(":")
+        low, high = (math.inf if n == "*" else int(n) for n in (start, end or start))
+        ranges.append((min(low, high), max(low, high)))
+    return ranges
+
+
+class PendingCommand:
+    """A command in flight, collecting the untagged responses sent for it until its tagged completion."""
+
+    def __init__(self, uids: Optional[List[Tuple[float, float]]] = None) -> None:
+        self.done = trio.Event()
+        self.untagged: Untagged = {}
+        self.status = ""
+        self.text = b""
+        self.error: Optional[str] = None
+        # UID ranges of the messages a pipelined command fetches or stores to
+        self.uids = uids
+
+    def owns(self, uid: int) -> bool:
+        return self.uids is not None and any(low <= uid <= high for low, high in self.uids)
+
+    def overlaps(self, uids: List[Tuple[float, float]]) -> bool:
+        return self.uids is not None and any(
+            low <= other_high and other_low <= high for low, high in self.uids for other_low, other_high in uids
+        )
+
+
+class ImapProtocol:
+    """Pipelined IMAP over a trio stream."""
+
+    def __init__(self, stream: trio.abc.Stream, depth: int = PIPELINE_DEPTH) -> None:
+        self.stream = stream
+        self.buffer = bytearray()
+        self.slots = trio.Semaphore(depth)
+        # Held while sending a pipelined command, and for the whole of a command that runs alone
+        self.send_lock = trio.Lock()
+        self.pending: Dict[bytes, PendingCommand] = {}  # In the order the commands were sent
+        self.idle = trio.Event()  # Set when no command is in flight
+        self.idle.set()
+        self.unsolicited: Untagged = {}
+        self.counter = 0
+
+    async def receive(self) -> None:
+        data = await self.stream.receive_some(RECEIVE_SIZE)
+        if not data:
+            raise EOFError("Connection closed by the server")
+        self.buffer += data
+
+    async def read_line(self) -> bytes:
+        start = 0
+        while (end := self.buffer.find(b"\r\n", start)) < 0:
+            start = max(0, len(self.buffer) - 1)
+            await self.receive()
+        line = bytes(self.buffer[:end])
+        del self.buffer[: end + 2]
+        return line
+
+    async def read_literal(self, size: int) -> bytes:
+        while len(self.buffer) < size:
+            await self.receive()
+        literal = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return literal
+
+    async def read_response(self, untagged: Optional[Untagged] = None) -> Optional[Tuple[bytes, str, bytes]]:
+        """Read one response, storing untagged data like imaplib does.
+
+        :param untagged: Where to store untagged data, by default that of the command in flight it belongs to
+        :return: (tag, status, text) for a tagged response, None otherwise
+        """
+        line = await self.read_line()
+        if not line.startswith(b"* "):
+            if line.startswith(b"+"):
+                logger.debug(f"Ignoring continuation response: {line!r}")
+                return None
+            tag, status, text = (line.split(b" ", 2) + [b"", b""])[:3]
+            return tag, status.decode(), text
+
+        if match := UNTAGGED_RESPONSE_RE.match(line):
+            dat = match.group("data") or b""
+        elif match := UNTAGGED_STATUS_RE.match(line):
+            dat = match.group("data") + (b" " + match.group("data2") if match.group("data2") else b"")
+        else:
+            raise imaplib.IMAP4.abort(f"unexpected response: {line!r}")
+        typ = match.group("type").decode()
+        items: List[Any] = []
+        while literal := LITERAL_RE.match(dat):
+            items.append((dat, await self.read_literal(int(literal.group("size")))))
+            dat = await self.read_line()
+        items.append(dat)
+        if untagged is None:
+            untagged = self.owner(typ, items)
+        untagged.setdefault(typ, []).extend(items)
+        if typ in ("OK", "NO", "BAD") and (code := RESPONSE_CODE_RE.match(dat)):
+            untagged.setdefault(code.group("type").decode(), []).append(code.group("data"))
+        return None
+
+    def owner(self, typ: str, items: List[Any]) -> Untagged:
+        """Untagged data of the command in flight an untagged response belongs to, or of no command."""
+        if typ == "FETCH":
+            text = b" ".join(item[0] if isinstance(item, tuple) else item for item in items)
+            if uid := UID_RE.search(text):
+                for pending in self.pending.values():
+                    if pending.owns(int(uid.group(1))):
+                        return pending.untagged
+        if len(self.pending) == 1:
+            # Either a command running alone, or the only one in flight
+            return next(iter(self.pending.values())).untagged
+        return self.unsolicited
+
+    async def read_responses(self) -> None:
+        """Dispatch responses to the commands in flight, until the connection is closed."""
+        try:
+            while True:
+                tagged = await self.read_response()
+                if tagged is None:
+                    continue
+                tag, status, text = tagged
+                pending = self.pending.pop(tag, None)
+                if pending is None:
+                    raise imaplib.IMAP4.abort(f"unexpected tagged response: {tag!r}")
+                pending.status, pending.text = status, text
+                pending.done.set()
+                if not self.pending:
+                    self.idle.set()
+        except (EOFError, trio.BrokenResourceError, trio.ClosedResourceError, imaplib.IMAP4.abort) as e:
+            for pending in self.pending.values():
+                pending.error = str(e)
+                pending.done.set()
+            self.pending.clear()
+            self.idle.set()
+
+    async def send(self, pending: PendingCommand, name: str, *args: str) -> None:
+        self.counter += 1
+        tag = b"P%d" % self.counter
+        self.pending[tag] = pending
+        self.idle = trio.Event()
+        await self.stream.send_all(b" ".join([tag, name.encode(), *(arg.encode() for arg in args)]) + b"\r\n")
+
+    async def command(self, name: str, *args: str) -> Tuple[str, Untagged, bytes]:
+        """Send a command and wait for its completion.
+
+        UID FETCH and UID STORE are sent without waiting for the commands in flight, unless one of those is for some of
+        the same messages. Other commands wait for all of them to complete, and hold back the commands issued after
+        them until their own completion.
+
+        :return: (status, untagged data by response type, text of the tagged response)
+        """
+        uids = None
+        if name == "UID" and len(args) > 1 and args[0].upper() in PIPELINED_COMMANDS:
+            try:
+                uids = uid_ranges(args[1])
+            except ValueError:
+                pass  # Not a plain UID set, run it alone
+        pipelined = uids is not None
+        async with self.slots:
+            pending = PendingCommand(uids)
+            async with self.send_lock:
+                if not pipelined:
+                    await self.idle.wait()
+                while blocker := next((other for other in self.pending.values() if other.overlaps(pending.uids or [])), None):
+                    await blocker.done.wait()
+                await self.send(pending, name, *args)
+                if not pipelined:
+                    await pending.done.wait()
+            await pending.done.wait()
+        if pending.error is not None:
+            raise imaplib.IMAP4.abort(pending.error)
+        if pending.status == "BAD":
+            raise imaplib.IMAP4.error(f"{name} command error: {pending.text!r}")
+        return pending.status, pending.untagged, pending.text
+
+
+class PipelinedIMAP4:
+    """
+    Drop-in for the parts of imaplib.IMAP4 used by imap_tools, backed by a pipelined ImapProtocol.
+
+    Unlike imaplib.IMAP4, it is safe to call from several threads at once, and concurrent calls are pipelined.
+    """
+
+    def __init__(self, host: str, port: int, ssl: bool = True, depth: int = PIPELINE_DEPTH) -> None:
+        self.capabilities: Tuple[str, ...] = ()
+        self.untagged_responses: Untagged = {}
+        self.ready = threading.Event()
+        self.error: Optional[BaseException] = None
+        self.token: Optional[trio.lowlevel.TrioToken] = None
+        self.protocol: Optional[ImapProtocol] = None
+        self.thread = threading.Thread(target=trio.run, args=(self.main, host, port, ssl, depth), daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+
+    async def main(self, host: str, port: int, ssl: bool, depth: int) -> None:
+        self.closed = trio.Event()
+        try:
+            stream = await (trio.open_ssl_over_tcp_stream(host, port) if ssl else trio.open_tcp_stream(host, port))
+            protocol = ImapProtocol(stream, depth)
+            await protocol.read_response(self.untagged_responses)  # Greeting
+        except BaseException as e:
+            self.error = e
+            self.ready.set()
+            raise
+        self.token = trio.lowlevel.current_trio_token()
+        self.protocol = protocol
+        async with stream, trio.open_nursery() as nursery:
+            nursery.start_soon(protocol.read_responses)
+            try:
+                _, untagged, _ = await protocol.command("CAPABILITY")
+                self.capabilities = tuple(untagged["CAPABILITY"][-1].decode().upper().split())
+            except BaseException as e:
+                self.error = e
+                raise
+            finally:
+                self.ready.set()
+            await self.closed.wait()
+            nursery.cancel_scope.cancel()
+
+    def command(self, name: str, *args: str) -> Tuple[str, Untagged, bytes]:
+        assert self.protocol is not None
+        return trio.from_thread.run(self.protocol.command, name, *args, trio_token=self.token)
+
+    def login(self, user: str, password: str) -> Tuple[str, List[bytes]]:
+        status, _, text = self.command("LOGIN", quote(user), quote(password))
+        if status != "OK":
+            raise imaplib.IMAP4.error(text)
+        return status, [text]
+
+    def select(self, mailbox: str = "INBOX", readonly: bool = False) -> Tuple[str, List[Any]]:
+        status, untagged, text = self.command("EXAMINE" if readonly else "SELECT", mailbox)
+        self.untagged_responses = untagged
+        if status != "OK":
+            return status, [text]
+        return status, untagged.get("EXISTS", [None])
+
+    def response(self, code: str) -> Tuple[str, List[Any]]:
+        return code, self.untagged_responses.pop(code.upper(), [None])
+
+    def uid(self, command: str, *args: Optional[str]) -> Tuple[str, List[Any]]:
+        command = command.upper()
+        status, untagged, text = self.command("UID", command, *(arg for arg in args if arg is not None))
+        if status != "OK":
+            return status, [text]
+        return status, untagged.get(command if command in ("SEARCH", "SORT", "THREAD") else "FETCH", [None])
+
+    def expunge(self) -> Tuple[str, List[Any]]:
+        status, untagged, text = self.command("EXPUNGE")
+        return status, untagged.get("EXPUNGE", [None]) if status == "OK" else [text]
+
+    def list(self, directory: str = '""', pattern: str = "*") -> Tuple[str, List[Any]]:
+        status, untagged, text = self.command("LIST", directory, pattern)
+        return status, untagged.get("LIST", [None]) if status == "OK" else [text]
+
+    def logout(self) -> Tuple[str, List[Any]]:
+        try:
+            status, untagged, _ = self.command("LOGOUT")
+        except imaplib.IMAP4.abort:
+            status, untagged = "BYE", {}
+        trio.from_thread.run_sync(self.closed.set, trio_token=self.token)
+        self.thread.join()
+        return status, untagged.get("BYE", [None])
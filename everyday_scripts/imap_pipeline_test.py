@@ -0,0 +1,89 @@
+import imaplib
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from tests.imap_server import ImapServer
+
+from .imap_pipeline import PipelinedIMAP4, quote
+
+
+@pytest.fixture
+def imap_server():
+    with ImapServer(messages=100, latency=0.01) as server:
+        yield server
+
+
+def connect(server, pipelined):
+    host, port = server.server_address[:2]
+    conn = PipelinedIMAP4(host, port, ssl=False) if pipelined else imaplib.IMAP4(host, port)
+    conn.login("user", "pass")
+    return conn
+
+
+def test_same_responses_as_imaplib(imap_server):
+    """Responses come back in the shapes imaplib returns"""
+    responses = []
+    for pipelined in [False, True]:
+        conn = connect(imap_server, pipelined)
+        got = [
+            conn.select("inbox", True),
+            conn.response("UIDVALIDITY"),
+            conn.uid("SEARCH", 'UNSEEN FROM "domain3.example.com"'),
+            conn.uid("FETCH", "1:3,7", "(UID RFC822.SIZE BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)])"),
+            conn.list(),
+        ]
+        assert "UIDPLUS" in conn.capabilities
+        conn.logout()
+        responses.append(got)
+    assert responses[0] == responses[1]
+
+
+def test_concurrent_commands_are_pipelined(imap_server):
+    conn = connect(imap_server, pipelined=True)
+    conn.select("inbox")
+
+    def fetch(uid):
+        return conn.uid("FETCH", str(uid), "(UID BODY.PEEK[HEADER.FIELDS (SUBJECT)])")
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(fetch, range(1, 41)))
+    conn.logout()
+
+    # Every thread gets the response to its own command
+    for uid, (status, data) in enumerate(results, 1):
+        assert status == "OK"
+        assert data[0][1] == f"Subject: Message {uid}\r\n\r\n".encode()
+
+
+def test_out_of_order_completions():
+    """Responses are matched to their commands on servers that complete pipelined commands in any order"""
+
+    def run(conn, i):
+        if i % 3 == 0:
+            return conn.uid("SEARCH", f'FROM "domain{i % 50}.example.com"')
+        return conn.uid("FETCH", f"{i}:{i + 1}", "(UID BODY.PEEK[HEADER.FIELDS (SUBJECT)])")
+
+    with ImapServer(messages=100, latency=0.01, reorder=True) as server:
+        conn = connect(server, pipelined=False)
+        conn.select("inbox")
+        expected = [run(conn, i) for i in range(1, 61)]
+        conn.logout()
+
+        conn = connect(server, pipelined=True)
+        conn.select("inbox")
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda i: run(conn, i), range(1, 61)))
+        conn.logout()
+    assert results == expected
+
+
+def test_bad_command(imap_server):
+    conn = connect(imap_server, pipelined=True)
+    with pytest.raises(imaplib.IMAP4.error):
+        conn.uid("SEARCH", "FOO")
+    conn.logout()
+
+
+def test_quote():
+    assert quote('pa"ss\\word') == '"pa\\"ss\\\\word"'
@@ -6,33 +6,73 @@ This is a toolkit for various operations on IMAP servers. Each subcommand is a t
 import click
 import imaplib
 import logging
-from contextlib import contextmanager
-from typing import Generator, Optional, List, Tuple
+import os
+import queue
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from typing import Callable, Dict, Generator, Iterable, Iterator, Optional, List, Sequence, Set, Tuple, TypeVar, Union
 from email.header import decode_header
 from prettytable import PrettyTable
 from collections import Counter
 import email
 import re
+import time
+from array import array
 import urllib.request
 
+from humanize import naturalsize
 from tqdm import tqdm
 
+from everyday_scripts.imap_pipeline import PipelinedIMAP4
+from everyday_scripts.scriptlib import chunks
+
+T = TypeVar("T")
+
 # Initialize logger
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Number of messages whose headers are fetched with a single UID FETCH command
+FETCH_BATCH_SIZE = 500
+# Number of sender patterns OR-ed together in one UID SEARCH, to stay well below command length limits
+SEARCH_BATCH_SIZE = 50
+# Number of IMAP connections commands are spread over
+POOL_SIZE = 4
+# Headers of a message never change while its mailbox keeps its UIDVALIDITY, so they are cached here
+HEADER_CACHE_FN = "headers.sqlite"
+UID_RE = re.compile(rb"\bUID (\d+)")
+SIZE_RE = re.compile(rb"\bRFC822\.SIZE (\d+)")
+LIST_RE = re.compile(rb'\((?P<flags>[^)]*)\) (?P<delimiter>"[^"]*"|NIL) (?P<name>.+)')
+EMAIL_RE = re.compile(r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b")
+# Patterns made only of these characters are looked up by their longest dot-free part before running the regex
+LITERAL_RE = re.compile(r"[\w%@.-]+", re.ASCII)
+BACKREF_RE = re.compile(r"\\[1-9]|\(\?P=")
+
 
 # Context manager for IMAP server connection
 @contextmanager
-def imap_connection(imap_server: str, username: str, password: str) -> Generator[imaplib.IMAP4, None, None]:
+def imap_connection(imap_server: str, username: str, password: str, pipeline: int = 1) -> Generator[imaplib.IMAP4, None, None]:
     """Context manager for connecting to an IMAP server.
 
-    :param imap_server: IMAP server address
+    :param imap_server: IMAP server address, optionally with a port. Prefix with imap:// for a plaintext connection, e.g.
+        to a local server.
     :param username: Email username
     :param password: Email password
+    :param pipeline: Number of commands to keep in flight. Above 1, a PipelinedIMAP4 is used instead of imaplib.
     """
     logger.debug(f"Connecting to IMAP server: {imap_server}")
-    conn = imaplib.IMAP4_SSL(imap_server)
+    scheme, _, address = imap_server.rpartition("://")
+    host, _, port = address.partition(":")
+    ssl = scheme != "imap"
+    port_number = int(port or (imaplib.IMAP4_SSL_PORT if ssl else imaplib.IMAP4_PORT))  # type: ignore[attr-defined]
+    conn: imaplib.IMAP4
+    if pipeline > 1:
+        conn = PipelinedIMAP4(host, port_number, ssl, pipeline)  # type: ignore[assignment]
+    elif ssl:
+        conn = imaplib.IMAP4_SSL(host, port_number)
+    else:
+        conn = imaplib.IMAP4(host, port_number)
     logger.debug("Connected successfully.")
     conn.login(username, password)
     logger.debug(f"Logged in as {username}.")
@@ -43,16 +83,484 @@ def imap_connection(imap_server: str, username: str, password: str) -> Generator
         logger.debug("Logged out.")
 
 
-def match_email_against_patterns(header: str, patterns: List[str]) -> Tuple[bool, List[str]]:
-    """Check if the given email matches any of the provided patterns."""
-    email_pattern = r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b"
-    match = re.search(email_pattern, header)
+class ConnectionPool:
+    """A fixed set of IMAP connections to the same mailbox, each used by one thread at a time."""
+
+    def __init__(self, conns: Sequence[imaplib.IMAP4]) -> None:
+        self.size = len(conns)
+        self.idle: queue.Queue[imaplib.IMAP4] = queue.Queue()
+        for conn in conns:
+            self.idle.put(conn)
+        self.mailbox: Optional[str] = None
+        self.uidvalidity: Optional[int] = None
+
+    @contextmanager
+    def connection(self) -> Generator[imaplib.IMAP4, None, None]:
+        """Borrow an idle connection, waiting for one if all are busy."""
+        conn = self.idle.get()
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+    def select(self, mailbox: str = "inbox", readonly: bool = False) -> bool:
+        """Select the mailbox on every connection, returning whether all succeeded."""
+        conns = [self.idle.get() for _ in range(self.size)]
+        try:
+            # A pipelined connection appears once for every command it can have in flight
+            distinct = {id(conn): conn for conn in conns}.values()
+            if not all(conn.select(mailbox, readonly)[0] == "OK" for conn in distinct):
+                return False
+            _, data = conns[0].response("UIDVALIDITY")
+            self.mailbox = mailbox
+            self.uidvalidity = int(data[0]) if data and data[0] else None
+            return True
+        finally:
+            for conn in conns:
+                self.idle.put(conn)
+
+    def search(self, criteria: Sequence[str]) -> List[bytes]:
+        """Run UID SEARCHes spread over the connections of the pool, returning the union of the UIDs found."""
+
+        def search(criterion: str) -> List[bytes]:
+            with self.connection() as conn:
+                status, data = conn.uid("SEARCH", criterion)
+            if status != "OK":
+                raise imaplib.IMAP4.error(f"SEARCH {criterion} failed: {data}")
+            return data[0].split()
+
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            found = {uid for uids in executor.map(search, criteria) for uid in uids}
+        return sorted(found, key=int)
+
+    def fetch_headers(
+        self,
+        uids: Sequence[bytes],
+        fields: str,
+        batch_size: int = FETCH_BATCH_SIZE,
+        cache: Optional["HeaderCache"] = None,
+    ) -> Iterator[Tuple[bytes, bytes]]:
+        """Like `fetch_headers`, with the batches of UIDs spread over the connections of the pool.
+
+        Results are yielded batch by batch, in the order of the UIDs, on the calling thread.
+
+        :param cache: Headers found in the cache are yielded first, and only the rest is fetched and then cached
+        """
+        if cache is not None:
+            cached = cache.get(uids, fields)
+            logger.debug(f"Found headers for {len(cached)} of {len(uids)} emails in the cache.")
+            yield from cached.items()
+            uids = [uid for uid in uids if uid not in cached]
+
+        for results in self.map_batches(lambda conn, batch: list(fetch_headers(conn, batch, fields, batch_size)), uids, batch_size):
+            if cache is not None:
+                cache.put(results, fields)
+            yield from results
+
+    def map_batches(
+        self, fn: Callable[[imaplib.IMAP4, List[bytes]], T], uids: Sequence[bytes], batch_size: int = FETCH_BATCH_SIZE
+    ) -> Iterator[T]:
+        """Call fn(connection, batch) for batches of the UIDs on the connections of the pool, yielding results in order."""
+
+        def call(batch: List[bytes]) -> T:
+            with self.connection() as conn:
+                return fn(conn, batch)
+
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            yield from executor.map(call, chunks(list(uids), batch_size))
+
+
+class HeaderCache:
+    """
+    Persistent cache of message headers in SQLite, keyed by (server, username, mailbox, UIDVALIDITY, UID).
+
+    UIDs are only unique within one UIDVALIDITY of a mailbox, so entries of older UIDVALIDITYs are dropped when it
+    changes. The set of header fields fetched is part of the key too.
+    """
+
+    def __init__(self, path: str, server: str, username: str, mailbox: str, uidvalidity: int) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.key = (server, username, mailbox, uidvalidity)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(headers)")]
+        if columns and "username" not in columns:
+            # Written by a version that mixed up the accounts of a server
+            self.conn.execute("DROP TABLE headers")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS headers (server TEXT, username TEXT, mailbox TEXT, uidvalidity INTEGER, fields TEXT, "
+            "uid INTEGER, raw BLOB NOT NULL, PRIMARY KEY (server, username, mailbox, uidvalidity, fields, uid))"
+        )
+        deleted = self.conn.execute(
+            "DELETE FROM headers WHERE server = ? AND username = ? AND mailbox = ? AND uidvalidity != ?", self.key
+        ).rowcount
+        if deleted:
+            logger.debug(f"UIDVALIDITY of {mailbox} changed, dropped {deleted} cached headers.")
+        self.conn.commit()
+
+    def get(self, uids: Sequence[bytes], fields: str) -> Dict[bytes, bytes]:
+        """Return the cached headers among the given UIDs, in the order of the UIDs."""
+        found: Dict[bytes, bytes] = {}
+        for batch in chunks([int(uid) for uid in uids], FETCH_BATCH_SIZE):
+            rows = self.conn.execute(
+                "SELECT uid, raw FROM headers WHERE server = ? AND username = ? AND mailbox = ? AND uidvalidity = ? AND fields = ? "
+                f"AND uid IN ({','.join('?' * len(batch))})",
+                (*self.key, fields, *batch),
+            )
+            found.update((str(uid).encode(), raw) for uid, raw in rows)
+        return {uid: found[uid] for uid in uids if uid in found}
+
+    def put(self, headers: Sequence[Tuple[bytes, bytes]], fields: str) -> None:
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(*self.key, fields, int(uid), raw) for uid, raw in headers],
+            )
+
+    def discard(self, uids: Iterable[bytes]) -> None:
+        """Forget the headers of deleted messages."""
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM headers WHERE server = ? AND username = ? AND mailbox = ? AND uidvalidity = ? AND uid = ?",
+                [(*self.key, int(uid)) for uid in uids],
+            )
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def cache_dir() -> str:
+    return os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "imap_tools")
+
+
+@contextmanager
+def header_cache(ctx: click.Context, pool: ConnectionPool) -> Generator[Optional[HeaderCache], None, None]:
+    """Context manager for the header cache of the selected mailbox, or None if caching is disabled."""
+    if not ctx.obj["CACHE"] or pool.mailbox is None or pool.uidvalidity is None:
+        yield None
+        return
+    cache = HeaderCache(
+        os.path.join(cache_dir(), HEADER_CACHE_FN), ctx.obj["IMAP_SERVER"], ctx.obj["USERNAME"], pool.mailbox, pool.uidvalidity
+    )
+    try:
+        yield cache
+    finally:
+        cache.close()
+
+
+@contextmanager
+def imap_pool(
+    imap_server: str, username: str, password: str, size: int = POOL_SIZE, pipeline: int = 1
+) -> Generator[ConnectionPool, None, None]:
+    """Context manager for a pool of connections to an IMAP server.
+
+    :param size: Number of connections to open
+    :param pipeline: Number of commands in flight on each connection. Each connection is then shared by as many
+        threads of the pool.
+    """
+    with ExitStack() as stack:
+        conns = [stack.enter_context(imap_connection(imap_server, username, password, pipeline)) for _ in range(max(1, size))]
+        yield ConnectionPool(conns * max(1, pipeline))
+
+
+class PatternMatcher:
+    """Sender patterns compiled once, to match many emails against large blocklists.
+
+    Every pattern matches exactly when ``re.search(pattern, email, re.IGNORECASE)`` would, so ``example.co`` matches
+    a@example.com and the dot matches any character. Patterns are split into two engines to get there quickly:
+
+    - patterns made only of word characters, ``%``, ``-``, ``@`` and dots, like most domains and addresses, are
+      indexed by their longest part without a dot, lowercased (``swiggy`` for ``swiggy.in``). The substrings of the
+      email are looked up in that index, and only the patterns found are searched as regexes.
+    - everything else is a regex. These are combined into a single alternation which rules out most emails with one
+      search; only emails that pass it are checked pattern by pattern.
+    """
+
+    def __init__(self, patterns: Sequence[str]) -> None:
+        self.patterns = list(patterns)
+        self.compiled = [re.compile(pattern, re.IGNORECASE) for pattern in self.patterns]
+        self.anchors: Dict[str, List[int]] = {}
+        self.regexes: List[int] = []
+        self.standalone: List[int] = []  # Backreferences would be renumbered in the alternation
+        for idx, pattern in enumerate(self.patterns):
+            anchor = max(pattern.lower().split("."), key=len)
+            if LITERAL_RE.fullmatch(pattern) and anchor:
+                self.anchors.setdefault(anchor, []).append(idx)
+            elif BACKREF_RE.search(pattern):
+                self.standalone.append(idx)
+            else:
+                self.regexes.append(idx)
+        self.anchor_lengths = sorted({len(anchor) for anchor in self.anchors})
+
+        self.combined: Optional[re.Pattern] = None
+        if self.regexes:
+            try:
+                self.combined = re.compile("|".join(f"(?:{self.patterns[idx]})" for idx in self.regexes), re.IGNORECASE)
+            except re.error:
+                # Patterns with inline global flags can't be combined; they are searched one by one
+                logger.debug("Could not combine the sender patterns into one regex.")
+                self.standalone.extend(self.regexes)
+                self.regexes = []
+
+    def __len__(self) -> int:
+        return len(self.patterns)
+
+    def search_criteria(self, batch_size: int = SEARCH_BATCH_SIZE) -> Optional[List[str]]:
+        """IMAP SEARCH criteria finding the unseen emails that may match, or None if the server can't narrow them down.
+
+        Every email matching a pattern contains its anchor, and FROM searches the whole header for it as a substring,
+        so the emails found are candidates to be matched client side. Regex patterns can match anything, so those need
+        all unseen emails.
+        """
+        if self.regexes or self.standalone or not self.patterns:
+            return None
+        criteria = []
+        for batch in chunks(list(self.anchors), batch_size):
+            # OR takes two search keys: OR OR FROM a FROM b FROM c
+            criteria.append("UNSEEN " + "OR " * (len(batch) - 1) + " ".join(f'FROM "{anchor}"' for anchor in batch))
+        return criteria
+
+    def match(self, email: str) -> List[str]:
+        """Return the patterns matching the email address, in the order they were given."""
+        candidates: Set[int] = set()
+        if email.isascii():
+            lowered = email.lower()
+            for length in self.anchor_lengths:
+                for start in range(len(lowered) - length + 1):
+                    candidates.update(self.anchors.get(lowered[start : start + length], ()))
+        else:
+            # Case folding can match non-ASCII characters to the ASCII ones of a pattern, like K (Kelvin) to k
+            candidates.update(idx for indexes in self.anchors.values() for idx in indexes)
+        if self.combined is not None and self.combined.search(email):
+            candidates.update(self.regexes)
+        candidates.update(self.standalone)
+        return [self.patterns[idx] for idx in sorted(candidates) if self.compiled[idx].search(email)]
+
+
+def match_email_against_patterns(header: str, patterns: Union[Sequence[str], PatternMatcher]) -> Tuple[bool, List[str]]:
+    """Check if the given email matches any of the provided patterns.
+
+    :param header: From header containing the email address
+    :param patterns: Patterns, ideally already compiled in a PatternMatcher when matching many emails
+    """
+    if not isinstance(patterns, PatternMatcher):
+        patterns = PatternMatcher(patterns)
+    match = EMAIL_RE.search(header)
     email = match.group() if match else ""
 
-    matching_patterns = [pattern for pattern in patterns if re.search(pattern, email, re.IGNORECASE)]
+    matching_patterns = patterns.match(email)
     return bool(matching_patterns), matching_patterns
 
 
+def uid_message_set(uids: Sequence[bytes]) -> str:
+    """Build a compact IMAP message set from UIDs, collapsing consecutive runs into ranges.
+
+    >>> uid_message_set([b"7", b"1", b"2", b"3", b"5"])
+    '1:3,5,7'
+    """
+    numbers = sorted(int(uid) for uid in uids)
+    parts = []
+    start = prev = None
+    for num in numbers:
+        if prev is not None and num == prev + 1:
+            prev = num
+            continue
+        if start is not None:
+            parts.append(f"{start}:{prev}" if prev != start else str(start))
+        start = prev = num
+    if start is not None:
+        parts.append(f"{start}:{prev}" if prev != start else str(start))
+    return ",".join(parts)
+
+
+def fetch_headers(
+    conn: imaplib.IMAP4, uids: Sequence[bytes], fields: str, batch_size: int = FETCH_BATCH_SIZE
+) -> Iterator[Tuple[bytes, bytes]]:
+    """Fetch the given header fields for a list of UIDs, a batch of messages per command.
+
+    Yields (uid, raw header bytes) for every message in the responses, as each batch arrives.
+
+    :param conn: Connection with a mailbox selected
+    :param uids: UIDs of the messages
+    :param fields: Space separated header field names, e.g. "FROM SUBJECT"
+    :param batch_size: Number of messages per UID FETCH command
+    """
+    for batch in chunks(list(uids), batch_size):
+        try:
+            status, msg_data = conn.uid("FETCH", uid_message_set(batch), f"(UID BODY.PEEK[HEADER.FIELDS ({fields})])")
+        except imaplib.IMAP4.error as e:
+            logger.warning(f"IMAP error while fetching headers for {len(batch)} emails: {e}")
+            continue
+        if status != "OK":
+            logger.warning(f"Error fetching headers for {len(batch)} emails: {msg_data}")
+            continue
+        for idx, part in enumerate(msg_data):
+            # Every message is a tuple of (envelope line, literal), followed by the rest of the line after the literal
+            if not isinstance(part, tuple):
+                continue
+            # Servers may send the UID before or after the literal
+            rest = msg_data[idx + 1] if idx + 1 < len(msg_data) else b""
+            match = UID_RE.search(part[0] + (rest if isinstance(rest, bytes) else b""))
+            if match:
+                yield match.group(1), part[1]
+
+
+def fetch_message_stats(conn: imaplib.IMAP4, uids: Sequence[bytes], batch_size: int = FETCH_BATCH_SIZE) -> List[Tuple[int, str, bytes]]:
+    """Fetch the size, arrival month and From/List-Id headers of messages, without their bodies.
+
+    :return: (size in bytes, month as YYYY-MM, raw header bytes) for every message in the responses
+    """
+    rows = []
+    for batch in chunks(list(uids), batch_size):
+        try:
+            status, msg_data = conn.uid(
+                "FETCH", uid_message_set(batch), "(UID RFC822.SIZE INTERNALDATE BODY.PEEK[HEADER.FIELDS (FROM LIST-ID)])"
+            )
+        except imaplib.IMAP4.error as e:
+            logger.warning(f"IMAP error while fetching {len(batch)} emails: {e}")
+            continue
+        if status != "OK":
+            logger.warning(f"Error fetching {len(batch)} emails: {msg_data}")
+            continue
+        for idx, part in enumerate(msg_data):
+            if not isinstance(part, tuple):
+                continue
+            # Servers may send the other items before or after the literal
+            rest = msg_data[idx + 1] if idx + 1 < len(msg_data) else b""
+            meta = part[0] + (rest if isinstance(rest, bytes) else b"")
+            size = SIZE_RE.search(meta)
+            date = imaplib.Internaldate2tuple(meta)
+            rows.append((int(size.group(1)) if size else 0, time.strftime("%Y-%m", date) if date else "", part[1]))
+    return rows
+
+
+def list_folders(conn: imaplib.IMAP4) -> List[str]:
+    """Names of all folders that can be selected, quoted for use in commands."""
+    status, data = conn.list()
+    if status != "OK":
+        return []
+    folders = []
+    for line in data:
+        match = LIST_RE.match(line) if isinstance(line, bytes) else None
+        if match and b"\\noselect" not in match.group("flags").lower():
+            name = match.group("name").decode(errors="ignore")
+            folders.append(name if name.startswith('"') else f'"{name}"')
+    return folders
+
+
+class Column:
+    """A column of strings stored as an array of codes into the distinct values."""
+
+    def __init__(self) -> None:
+        self.values: List[str] = []
+        self.index: Dict[str, int] = {}
+        self.codes = array("I")
+
+    def append(self, value: str) -> None:
+        code = self.index.get(value)
+        if code is None:
+            code = self.index[value] = len(self.values)
+            self.values.append(value)
+        self.codes.append(code)
+
+
+class MessageTable:
+    """Per-message rows for mailbox statistics, kept in compact columns rather than one object per message."""
+
+    COLUMNS = ["folder", "sender", "domain", "list_id", "month"]
+
+    def __init__(self) -> None:
+        self.columns = {name: Column() for name in self.COLUMNS}
+        self.sizes = array("Q")
+
+    def __len__(self) -> int:
+        return len(self.sizes)
+
+    def add(self, size: int, **values: str) -> None:
+        for name, column in self.columns.items():
+            column.append(values[name])
+        self.sizes.append(size)
+
+    def add_message(self, folder: str, size: int, month: str, raw_header: bytes) -> None:
+        msg = email.message_from_bytes(raw_header)
+        sender = (sender_address(raw_header) or "").lower()
+        list_id = str(msg.get("List-Id") or "").strip()
+        match = re.search(r"<([^>]+)>", list_id)
+        self.add(
+            size,
+            folder=folder,
+            sender=sender,
+            domain=sender.rpartition("@")[2],
+            list_id=match.group(1) if match else list_id,
+            month=month,
+        )
+
+    def aggregate(self, name: str) -> List[Tuple[str, int, int]]:
+        """Return (value, message count, total bytes) for every value of a column, largest total first."""
+        column = self.columns[name]
+        counts = [0] * len(column.values)
+        sizes = [0] * len(column.values)
+        for code, size in zip(column.codes, self.sizes):
+            counts[code] += 1
+            sizes[code] += size
+        return sorted(zip(column.values, counts, sizes), key=lambda row: (-row[2], row[0]))
+
+
+def delete_uids(conn: imaplib.IMAP4, uids: Sequence[bytes], batch_size: int = FETCH_BATCH_SIZE) -> List[bytes]:
+    """Delete messages by UID, flagging a batch at a time and expunging once per batch.
+
+    UIDs stay valid across expunges, unlike sequence numbers. With UIDPLUS, only the messages of the batch are
+    expunged.
+
+    :return: UIDs of the messages that were deleted
+    """
+    uidplus = "UIDPLUS" in conn.capabilities
+    deleted: List[bytes] = []
+    for batch in chunks(list(uids), batch_size):
+        message_set = uid_message_set(batch)
+        try:
+            status, data = conn.uid("STORE", message_set, "+FLAGS.SILENT", "(\\Deleted)")
+            if status != "OK":
+                logger.warning(f"Error flagging {len(batch)} emails for deletion: {data}")
+                continue
+            if uidplus:
+                conn.uid("EXPUNGE", message_set)
+            else:
+                conn.expunge()
+        except imaplib.IMAP4.error as e:
+            logger.warning(f"IMAP error while deleting {len(batch)} emails: {e}")
+            continue
+        deleted.extend(batch)
+    return deleted
+
+
+def decode_from_subject(raw_header: bytes) -> Tuple[str, str]:
+    """Decode the From and Subject headers from raw header bytes."""
+    msg = email.message_from_bytes(raw_header)
+
+    from_header = decode_header(msg.get("From", ""))[0][0]
+    from_header = from_header.decode(errors="ignore") if isinstance(from_header, bytes) else from_header
+
+    subject_header = msg.get("Subject", "")  # Use an empty string as default if "Subject" is None
+    subject_header = decode_header(subject_header)[0][0]
+    if isinstance(subject_header, bytes):
+        subject_header = subject_header.decode(errors="ignore")
+    return from_header, subject_header
+
+
+def sender_address(raw_header: bytes) -> Optional[str]:
+    """Extract the sender email address from raw From header bytes."""
+    msg = email.message_from_bytes(raw_header)
+    if msg["From"] is None:
+        return None
+    from_header = decode_header(msg["From"])[0][0]
+    sender_email = re.search(
+        r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b",
+        from_header.decode(errors="ignore") if isinstance(from_header, bytes) else from_header,
+    )
+    return sender_email.group() if sender_email else None
+
+
 CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
 
 
@@ -89,14 +597,49 @@ CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
     type=bool,
     envvar="IMAP_TOOLKIT_VERBOSE",
 )
+@click.option(
+    "-c",
+    "--connections",
+    default=POOL_SIZE,
+    help="Number of connections to the IMAP server to spread commands over. Can also be set via IMAP_TOOLKIT_CONNECTIONS env var.",
+    type=int,
+    envvar="IMAP_TOOLKIT_CONNECTIONS",
+)
+@click.option(
+    "-P",
+    "--pipeline",
+    default=1,
+    help="Number of commands to keep in flight on each connection, for servers that limit connections. "
+    "Above 1, commands are pipelined. Can also be set via IMAP_TOOLKIT_PIPELINE env var.",
+    type=int,
+    envvar="IMAP_TOOLKIT_PIPELINE",
+)
+@click.option(
+    "--cache/--no-cache",
+    default=True,
+    help="Cache fetched headers locally, so that repeat runs only fetch new emails. Can also be set via IMAP_TOOLKIT_CACHE env var.",
+    envvar="IMAP_TOOLKIT_CACHE",
+)
 @click.pass_context
-def cli(ctx: click.Context, imap_server: str, username: str, password: str, verbose: bool) -> None:
+def cli(
+    ctx: click.Context,
+    imap_server: str,
+    username: str,
+    password: str,
+    verbose: bool,
+    connections: int,
+    pipeline: int,
+    cache: bool,
+) -> None:
     """Toolkit for various operations on IMAP servers."""
     ctx.ensure_object(dict)
     ctx.obj["IMAP_SERVER"] = imap_server
     ctx.obj["USERNAME"] = username
     ctx.obj["PASSWORD"] = password
     ctx.obj["VERBOSE"] = verbose
+    ctx.obj["CONNECTIONS"] = connections
+    ctx.obj["CACHE"] = cache
+    ctx.obj["PIPELINE"] = pipeline
     if verbose:
         logger.setLevel(logging.DEBUG)
 
@@ -114,41 +657,38 @@ def cli(ctx: click.Context, imap_server: str, username: str, password: str, verb
     help="Maximum number of emails to analyze. If not specified, all unread emails will be analyzed.",
     type=int,
 )
+@click.option(
+    "--batch-size",
+    default=FETCH_BATCH_SIZE,
+    help="Number of messages to fetch headers for in one command",
+    type=int,
+)
 @click.pass_context
-def stats_senders(ctx: click.Context, top_count: int, max_emails: Optional[int]) -> None:
+def stats_senders(ctx: click.Context, top_count: int, max_emails: Optional[int], batch_size: int) -> None:
     """Output the most common sender email addresses among unread messages."""
     imap_server = ctx.obj["IMAP_SERVER"]
     username = ctx.obj["USERNAME"]
     password = ctx.obj["PASSWORD"]
 
-    with imap_connection(imap_server, username, password) as conn:
+    with imap_pool(imap_server, username, password, ctx.obj["CONNECTIONS"], ctx.obj["PIPELINE"]) as pool:
         logger.debug("Selecting the inbox.")
-        status, _ = conn.select("inbox")
-        if status == "OK":
+        if pool.select("inbox"):
             logger.debug("Inbox selected successfully.")
-            status, msgnums = conn.search(None, "UNSEEN")
-            msgnums = msgnums[0].split()
-            msgnums = sorted(msgnums, reverse=True)  # latest emails first
+            with pool.connection() as conn:
+                status, uids = conn.uid("SEARCH", "UNSEEN")
+            uids = uids[0].split()
+            uids = sorted(uids, key=int, reverse=True)  # latest emails first
             if max_emails is not None:
-                msgnums = msgnums[:max_emails]
-            logger.debug(f"Analyzing {len(msgnums)} unread messages.")
-            if msgnums:
+                uids = uids[:max_emails]
+            logger.debug(f"Analyzing {len(uids)} unread messages.")
+            if uids:
                 email_counter = Counter()
-                for num in tqdm(msgnums, desc="Processing emails", unit="email"):
-                    status, msg_data = conn.fetch(num, "(BODY.PEEK[HEADER.FIELDS (FROM)])")
-                    if msg_data and msg_data[0] is not None:
-                        raw_email = msg_data[0][1]
-                    else:
-                        continue
-                    msg = email.message_from_bytes(raw_email)  # type: ignore
-                    from_header = decode_header(msg["From"])[0][0]
-                    sender_email = re.search(
-                        r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b",
-                        from_header.decode(errors="ignore") if isinstance(from_header, bytes) else from_header,
-                    )
-
-                    if sender_email:
-                        email_counter[sender_email.group()] += 1
+                with header_cache(ctx, pool) as cache, tqdm(total=len(uids), desc="Processing emails", unit="email") as progress:
+                    for _, raw_header in pool.fetch_headers(uids, "FROM", batch_size, cache):
+                        progress.update()
+                        sender_email = sender_address(raw_header)
+                        if sender_email:
+                            email_counter[sender_email] += 1
 
                 # Show top sender email addresses in PrettyTable
                 x = PrettyTable()
@@ -163,6 +703,71 @@ def stats_senders(ctx: click.Context, top_count: int, max_emails: Optional[int])
             click.echo("Failed to select the inbox.")
 
 
+@cli.command()
+@click.option(
+    "-f",
+    "--folder",
+    "folders",
+    multiple=True,
+    help="Folder to analyze. Can be given multiple times. Defaults to the inbox.",
+)
+@click.option("-a", "--all-folders", is_flag=True, help="Analyze every folder in the account.")
+@click.option(
+    "--top-count",
+    default=10,
+    help="Number of rows to display for each breakdown",
+    type=int,
+)
+@click.option(
+    "--batch-size",
+    default=FETCH_BATCH_SIZE,
+    help="Number of messages to fetch in one command",
+    type=int,
+)
+@click.pass_context
+def stats(ctx: click.Context, folders: Tuple[str, ...], all_folders: bool, top_count: int, batch_size: int) -> None:
+    """Break down the messages and bytes in folders by sender, domain, mailing list and month.
+
+    Only sizes, dates and a few headers are fetched, never message bodies.
+    """
+    imap_server = ctx.obj["IMAP_SERVER"]
+    username = ctx.obj["USERNAME"]
+    password = ctx.obj["PASSWORD"]
+
+    table = MessageTable()
+    with imap_pool(imap_server, username, password, ctx.obj["CONNECTIONS"], ctx.obj["PIPELINE"]) as pool:
+        if all_folders:
+            with pool.connection() as conn:
+                folders = tuple(list_folders(conn))
+        for folder in folders or ("inbox",):
+            if not pool.select(folder, readonly=True):
+                click.echo(f"Failed to select {folder}.")
+                continue
+            with pool.connection() as conn:
+                status, uids = conn.uid("SEARCH", "ALL")
+            uids = uids[0].split()
+            logger.debug(f"Analyzing {len(uids)} messages in {folder}.")
+            with tqdm(total=len(uids), desc=folder, unit="email") as progress:
+                for rows in pool.map_batches(lambda conn, batch: fetch_message_stats(conn, batch, batch_size), uids, batch_size):
+                    progress.update(len(rows))
+                    for size, month, raw_header in rows:
+                        table.add_message(folder.strip('"'), size, month, raw_header)
+
+    if not table:
+        click.echo("No messages found.")
+        return
+    for name, title in [("sender", "Sender"), ("domain", "Domain"), ("list_id", "List-Id"), ("month", "Month"), ("folder", "Folder")]:
+        x = PrettyTable()
+        x.field_names = [title, "Count", "Size"]
+        x.align[title] = "l"
+        x.align["Count"] = x.align["Size"] = "r"
+        for value, count, size in table.aggregate(name)[:top_count]:
+            x.add_row([value or "-", count, naturalsize(size, binary=True)])
+        print(x)
+    total_size = click.style(naturalsize(sum(table.sizes), binary=True), fg="red")
+    click.echo(f"Total messages: {click.style(str(len(table)), fg='blue')}, total size: {total_size}")
+
+
 @cli.command()
 @click.option(
     "-f",
@@ -190,6 +795,19 @@ def stats_senders(ctx: click.Context, top_count: int, max_emails: Optional[int])
     help="Maximum number of unread emails to process.",
 )
 @click.option("-n", "--no-progress", is_flag=True, help="Disable the progress meter.")
+@click.option(
+    "-b",
+    "--batch-size",
+    type=int,
+    default=FETCH_BATCH_SIZE,
+    help="Number of messages to fetch headers for, or delete, in one command.",
+)
+@click.option(
+    "--server-search/--no-server-search",
+    default=True,
+    help="Let the server find the emails from senders that are plain addresses or domains, "
+    "instead of fetching the headers of all unread emails.",
+)
 @click.pass_context
 def delete_matching(
     ctx: click.Context,
@@ -198,6 +816,8 @@ def delete_matching(
     allow_all: bool,
     max_process: Optional[int],
     no_progress: bool,
+    batch_size: int,
+    server_search: bool,
 ) -> None:
     """Delete unread emails where the sender matches any of the given patterns."""
     deleted_count: int = 0
@@ -218,72 +838,67 @@ def delete_matching(
             patterns.extend(url_patterns)
             logger.debug(f"Loaded {len(url_patterns)} patterns from {url_path}.")
     logger.debug(f"Total number of patterns: {len(patterns)}")
+    matcher = PatternMatcher(patterns)
 
     imap_server = ctx.obj["IMAP_SERVER"]
     username = ctx.obj["USERNAME"]
     password = ctx.obj["PASSWORD"]
 
-    with imap_connection(imap_server, username, password) as conn:
-        status, data = conn.select("inbox")
-        if status != "OK":
+    with imap_pool(imap_server, username, password, ctx.obj["CONNECTIONS"], ctx.obj["PIPELINE"]) as pool:
+        if not pool.select("inbox"):
             click.echo("Failed to select the inbox.")
             return
 
-        status, msgnums = conn.search(None, "UNSEEN")
-        msgnums = msgnums[0].split()
-        if max_process:
-            msgnums = sorted(msgnums, reverse=True)[:max_process]
-
-        if allow_all and not no_progress:  # Only show progress indicator if --allow-all is set and --no-progress is not set
-            msgnums_iter = tqdm(msgnums, desc="Processing emails", unit="email")
+        criteria = matcher.search_criteria() if server_search else None
+        if criteria is not None:
+            logger.debug(f"Searching for unread emails from the senders with {len(criteria)} commands.")
+            uids = pool.search(criteria)
         else:
-            msgnums_iter = msgnums  # No progress indicator for interactive mode
-
-        for num in msgnums_iter:
-            processed_count += 1
-            try:
-                status, msg_data = conn.fetch(num, "(BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)])")
-                if status != "OK":
-                    logger.warning(f"Error fetching email {num}: {msg_data}")
-                    continue  # Skip this iteration and move to the next email
-            except imaplib.IMAP4.error as e:
-                logger.warning(f"IMAP error while fetching email {num}: {e}")
-                continue  # Skip this iteration and move to the next email
-
-            raw_email = msg_data[0][1]  # type: ignore
-            msg = email.message_from_bytes(raw_email)  # type: ignore
-
-            from_header = decode_header(msg["From"])[0][0]
-            # print(num, from_header)
-            from_header = from_header.decode(errors="ignore") if isinstance(from_header, bytes) else from_header
-
-            subject_header = msg.get("Subject", "")  # Use an empty string as default if "Subject" is None
-            if subject_header is not None:
-                subject_header = decode_header(subject_header)[0][0]
-                if isinstance(subject_header, bytes):
-                    subject_header = subject_header.decode(errors="ignore")
-
-            matched, matching_patterns = match_email_against_patterns(from_header, patterns)
-            if matched:
-                logger.debug(f"Matching pattern for header [{from_header}]: [{','.join(matching_patterns)}]")
-                colored_from_header = click.style(from_header, fg="green")
-                colored_subject_header = click.style(subject_header, fg="yellow")
-                deleted = False
-                if not allow_all:
-                    if click.confirm(f"Do you want to delete email from {colored_from_header} with subject {colored_subject_header}?"):
-                        conn.store(num, "+FLAGS", "(\\Deleted)")
-                        conn.expunge()
-                        deleted_count += 1
-                        deleted = True
-
-                else:
-                    conn.store(num, "+FLAGS", "(\\Deleted)")
-                    conn.expunge()
-                    deleted_count += 1
-                    deleted = True
-
-                if deleted:  # and not isinstance(msgnums_iter, tqdm):
+            with pool.connection() as conn:
+                status, uids = conn.uid("SEARCH", "UNSEEN")
+            uids = uids[0].split()
+        if max_process:
+            uids = sorted(uids, key=int, reverse=True)[:max_process]
+
+        # Only show progress indicator if --allow-all is set and --no-progress is not set
+        show_progress = allow_all and not no_progress
+        to_delete: List[Tuple[bytes, str, str]] = []  # (uid, colored from, colored subject)
+
+        def flush(cache: Optional[HeaderCache]) -> int:
+            with pool.connection() as conn:
+                deleted_uids = set(delete_uids(conn, [uid for uid, _, _ in to_delete], batch_size))
+            if cache is not None:
+                cache.discard(deleted_uids)
+            for uid, colored_from_header, colored_subject_header in to_delete:
+                if uid in deleted_uids:
                     click.echo(f"Email from {colored_from_header} with subject {colored_subject_header} deleted.")
+            to_delete.clear()
+            return len(deleted_uids)
+
+        with (
+            header_cache(ctx, pool) as cache,
+            tqdm(total=len(uids), desc="Processing emails", unit="email", disable=not show_progress) as progress,
+        ):
+            for uid, raw_header in pool.fetch_headers(uids, "FROM SUBJECT", batch_size, cache):
+                processed_count += 1
+                progress.update()
+                from_header, subject_header = decode_from_subject(raw_header)
+
+                matched, matching_patterns = match_email_against_patterns(from_header, matcher)
+                if matched:
+                    logger.debug(f"Matching pattern for header [{from_header}]: [{','.join(matching_patterns)}]")
+                    colored_from_header = click.style(from_header, fg="green")
+                    colored_subject_header = click.style(subject_header, fg="yellow")
+                    if allow_all or click.confirm(
+                        f"Do you want to delete email from {colored_from_header} with subject {colored_subject_header}?"
+                    ):
+                        to_delete.append((uid, colored_from_header, colored_subject_header))
+
+                # Confirmed emails are deleted right away, so that quitting at a prompt keeps the answers given so far
+                if to_delete and (not allow_all or len(to_delete) >= batch_size):
+                    deleted_count += flush(cache)
+            deleted_count += flush(cache)
+
     colored_processed_count = click.style(str(processed_count), fg="blue")
     colored_deleted_count = click.style(str(deleted_count), fg="red")
 
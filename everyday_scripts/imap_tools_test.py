@@ -1,5 +1,24 @@
+import imaplib
+import re
+import click
 import pytest
-from .imap_tools import match_email_against_patterns
+from click.testing import CliRunner
+
+from tests.imap_server import ImapServer
+from .imap_tools import (
+    ConnectionPool,
+    HeaderCache,
+    MessageTable,
+    PatternMatcher,
+    cli,
+    delete_uids,
+    fetch_headers,
+    fetch_message_stats,
+    list_folders,
+    match_email_against_patterns,
+    sender_address,
+    uid_message_set,
+)
 
 
 @pytest.mark.parametrize(
@@ -22,3 +41,302 @@ from .imap_tools import match_email_against_patterns
 def test_match_email_against_patterns(header, patterns, expected_result):
     result = match_email_against_patterns(header, patterns)
     assert result == expected_result
+
+
+@pytest.mark.parametrize(
+    "email, expected",
+    [
+        ("promo@mail.swiggy.in", ["swiggy.in", "^promo"]),
+        ("x@notswiggy.in", ["swiggy.in"]),
+        ("x@swiggyxin.com", ["swiggy.in"]),
+        ("news@example.com", ["News@Example.com", "@example.com", "example"]),
+        ("other@example.com", ["@example.com", "example"]),
+        ("aa@b.com", [r"(a)\1"]),
+        ("nobody@nowhere.org", []),
+    ],
+)
+def test_pattern_matcher(email, expected):
+    patterns = ["swiggy.in", "News@Example.com", "@example.com", "example", "^promo", r"(a)\1"]
+    assert PatternMatcher(patterns).match(email) == expected
+
+
+@pytest.mark.parametrize(
+    "pattern, email",
+    [
+        ("john.doe", "john.doe@example.com"),
+        ("info@swiggy", "info@swiggy.in"),
+        ("mail.timesjobs", "x@mail.timesjobs.com"),
+        ("example.co", "a@example.com"),
+        ("Example.COM", "a@EXAMPLE.com"),
+        ("a.b", "a@b.com"),
+        ("k@x", "\u212a@x.org"),  # KELVIN SIGN folds to k
+        ("swiggy.in", "promo@swiggy.info"),
+        ("swiggy.in", "x@example.com"),
+        ("@example.com", "a@b.example.com"),
+    ],
+)
+def test_pattern_matcher_like_re_search(pattern, email):
+    """Patterns match exactly like the regex search they always were"""
+    expected = [pattern] if re.search(pattern, email, re.IGNORECASE) else []
+    assert PatternMatcher([pattern, "^nomatch$"]).match(email) == expected
+
+
+@pytest.mark.parametrize(
+    "uids, expected",
+    [
+        ([b"1"], "1"),
+        ([b"3", b"1", b"2"], "1:3"),
+        ([b"10", b"1", b"2", b"4", b"5", b"8"], "1:2,4:5,8,10"),
+        ([], ""),
+    ],
+)
+def test_uid_message_set(uids, expected):
+    assert uid_message_set(uids) == expected
+
+
+class FakeFetchConnection:
+    """Answers UID FETCH like imaplib does, recording the commands"""
+
+    def __init__(self, senders, uid_after_literal=False):
+        self.senders = senders
+        self.uid_after_literal = uid_after_literal
+        self.commands = []
+
+    def uid(self, command, message_set, items):
+        self.commands.append((command, message_set))
+        data = []
+        for part in message_set.split(","):
+            start, _, end = part.partition(":")
+            for uid in range(int(start), int(end or start) + 1):
+                header = f"From: {self.senders[uid]}\r\n\r\n".encode()
+                if self.uid_after_literal:
+                    data.append((f"{uid} (BODY[HEADER.FIELDS (FROM)] {{{len(header)}}}".encode(), header))
+                    data.append(f" UID {uid})".encode())
+                else:
+                    data.append((f"{uid} (UID {uid} BODY[HEADER.FIELDS (FROM)] {{{len(header)}}}".encode(), header))
+                    data.append(b")")
+        return "OK", data
+
+
+@pytest.mark.parametrize("uid_after_literal", [False, True])
+def test_fetch_headers_batches(uid_after_literal):
+    senders = {uid: f"Sender {uid} <s{uid}@example.com>" for uid in range(1, 12)}
+    conn = FakeFetchConnection(senders, uid_after_literal)
+    uids = [str(uid).encode() for uid in senders]
+    got = [(uid, sender_address(raw)) for uid, raw in fetch_headers(conn, uids, "FROM", batch_size=5)]
+    assert got == [(str(uid).encode(), f"s{uid}@example.com") for uid in senders]
+    assert conn.commands == [("FETCH", "1:5"), ("FETCH", "6:10"), ("FETCH", "11")]
+
+
+def test_connection_pool_fetch_headers():
+    senders = {uid: f"Sender {uid} <s{uid}@example.com>" for uid in range(1, 101)}
+    conns = [FakeFetchConnection(senders) for _ in range(3)]
+    pool = ConnectionPool(conns)
+    uids = [str(uid).encode() for uid in senders]
+    got = [(uid, sender_address(raw)) for uid, raw in pool.fetch_headers(uids, "FROM", batch_size=10)]
+    assert got == [(str(uid).encode(), f"s{uid}@example.com") for uid in senders]
+    assert sorted(message_set for conn in conns for _, message_set in conn.commands) == sorted(
+        f"{start}:{start + 9}" for start in range(1, 101, 10)
+    )
+
+
+class FakeStoreConnection:
+    """Answers UID STORE/EXPUNGE and EXPUNGE, recording the commands"""
+
+    def __init__(self, capabilities):
+        self.capabilities = capabilities
+        self.commands = []
+
+    def uid(self, command, message_set, *args):
+        self.commands.append((command, message_set, *args))
+        return "OK", [None]
+
+    def expunge(self):
+        self.commands.append(("EXPUNGE",))
+        return "OK", [None]
+
+
+@pytest.mark.parametrize(
+    "capabilities, expunge",
+    [
+        (("IMAP4REV1", "UIDPLUS"), [("EXPUNGE", "1:3"), ("EXPUNGE", "7")]),
+        (("IMAP4REV1",), [("EXPUNGE",), ("EXPUNGE",)]),
+    ],
+)
+def test_delete_uids_batches(capabilities, expunge):
+    conn = FakeStoreConnection(capabilities)
+    assert delete_uids(conn, [b"1", b"2", b"3", b"7"], batch_size=3) == [b"1", b"2", b"3", b"7"]
+    assert conn.commands == [
+        ("STORE", "1:3", "+FLAGS.SILENT", "(\\Deleted)"),
+        expunge[0],
+        ("STORE", "7", "+FLAGS.SILENT", "(\\Deleted)"),
+        expunge[1],
+    ]
+
+
+def test_header_cache(tmp_path):
+    senders = {uid: f"Sender {uid} <s{uid}@example.com>" for uid in range(1, 21)}
+    conn = FakeFetchConnection(senders)
+    pool = ConnectionPool([conn])
+    path = str(tmp_path / "cache" / "headers.sqlite")
+    uids = [str(uid).encode() for uid in range(1, 11)]
+
+    cache = HeaderCache(path, "imap.example.com", "alice", "inbox", 1)
+    first = list(pool.fetch_headers(uids, "FROM", batch_size=5, cache=cache))
+    cache.close()
+    assert conn.commands == [("FETCH", "1:5"), ("FETCH", "6:10")]
+
+    # Only the new emails are fetched, and cached headers are as fetched
+    conn.commands.clear()
+    cache = HeaderCache(path, "imap.example.com", "alice", "inbox", 1)
+    more = [str(uid).encode() for uid in range(1, 21)]
+    second = dict(pool.fetch_headers(more, "FROM", batch_size=5, cache=cache))
+    assert conn.commands == [("FETCH", "11:15"), ("FETCH", "16:20")]
+    assert [(uid, second[uid]) for uid in uids] == first
+    # A different set of fields is not served from the cache
+    assert cache.get(uids, "FROM SUBJECT") == {}
+    cache.discard([b"1"])
+    assert list(cache.get(uids, "FROM")) == uids[1:]
+    cache.close()
+
+    # Another account on the same server has its own mailboxes
+    cache = HeaderCache(path, "imap.example.com", "bob", "inbox", 1)
+    assert cache.get(more, "FROM") == {}
+    cache.close()
+
+    # A new UIDVALIDITY invalidates everything cached for the mailbox
+    cache = HeaderCache(path, "imap.example.com", "alice", "inbox", 2)
+    assert cache.get(more, "FROM") == {}
+    cache.close()
+
+
+@pytest.mark.parametrize(
+    "patterns, expected",
+    [
+        (
+            ["swiggy.in", "a@b.com", "@example.com"],
+            ['UNSEEN OR FROM "swiggy" FROM "a@b"', 'UNSEEN FROM "@example"'],
+        ),
+        (["example.com", "mail.example.com", "newsletters.com"], ['UNSEEN OR FROM "example" FROM "newsletters"']),
+        (["swiggy.in", "^promo"], None),
+        (["bücher.de"], None),
+    ],
+)
+def test_pattern_matcher_search_criteria(patterns, expected):
+    assert PatternMatcher(patterns).search_criteria(batch_size=2) == expected
+
+
+class FakeSearchConnection:
+    """Answers UID SEARCH with the UIDs listed for each criterion"""
+
+    def __init__(self, results):
+        self.results = results
+
+    def uid(self, command, criterion):
+        return "OK", [b" ".join(self.results[criterion])]
+
+
+def test_connection_pool_search():
+    results = {"a": [b"3", b"10"], "b": [b"10", b"2"], "c": []}
+    pool = ConnectionPool([FakeSearchConnection(results) for _ in range(2)])
+    assert pool.search(["a", "b", "c"]) == [b"2", b"3", b"10"]
+
+
+class FakeStatsConnection:
+    """Answers UID FETCH of sizes, dates and headers, with items on both sides of the literal like some servers do"""
+
+    def uid(self, command, message_set, items):
+        if message_set != "1:2":
+            raise imaplib.IMAP4.error("UID command error: BAD [b'Invalid message set']")
+        header = b"From: A <a@lists.example.com>\r\nList-Id: Announcements <announce.example.com>\r\n\r\n"
+        return "OK", [
+            (
+                b'1 (UID 1 RFC822.SIZE 2048 INTERNALDATE "17-Jul-2023 02:44:25 +0000" BODY[HEADER.FIELDS (FROM LIST-ID)] {%d}'
+                % len(header),
+                header,
+            ),
+            b")",
+            (b"2 (UID 2 BODY[HEADER.FIELDS (FROM LIST-ID)] {14}", b"From: b@x.org\r\n"),
+            b' RFC822.SIZE 100 INTERNALDATE "01-Aug-2023 12:00:00 +0000")',
+        ]
+
+    def list(self):
+        return "OK", [
+            b'(\\HasNoChildren) "/" "INBOX"',
+            b'(\\Noselect \\HasChildren) "/" "[Gmail]"',
+            b'(\\HasNoChildren \\Sent) "/" "[Gmail]/Sent Mail"',
+            b'(\\HasNoChildren) "." Archive',
+        ]
+
+
+def test_fetch_message_stats():
+    # The batch the server rejects is skipped
+    rows = fetch_message_stats(FakeStatsConnection(), [b"1", b"2", b"3"], batch_size=2)
+    assert [(size, month) for size, month, _ in rows] == [(2048, "2023-07"), (100, "2023-08")]
+
+    table = MessageTable()
+    for size, month, raw_header in rows:
+        table.add_message("INBOX", size, month, raw_header)
+    assert table.aggregate("domain") == [("lists.example.com", 1, 2048), ("x.org", 1, 100)]
+    assert table.aggregate("list_id") == [("announce.example.com", 1, 2048), ("", 1, 100)]
+    assert table.aggregate("folder") == [("INBOX", 2, 2148)]
+
+
+def test_list_folders():
+    assert list_folders(FakeStatsConnection()) == ['"INBOX"', '"[Gmail]/Sent Mail"', '"Archive"']
+
+
+@pytest.fixture
+def imap_server(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    with ImapServer(messages=200) as server:
+        yield server
+
+
+def run_cli(server, *args):
+    result = CliRunner().invoke(cli, ["-s", server.url, "-u", "user", "-p", "pass", *args], catch_exceptions=False)
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def test_stats_senders_end_to_end(imap_server):
+    def table(output):
+        return [line for line in output.splitlines() if line.startswith("|")]
+
+    rows = table(run_cli(imap_server, "stats-senders", "--top-count", "1"))
+    assert len(rows) == 2 and "@domain" in rows[1]
+    # Served from the header cache the second time
+    assert table(run_cli(imap_server, "stats-senders", "--top-count", "1")) == rows
+
+
+# A domain the server can search for, and a regex matched client side
+@pytest.mark.parametrize("pattern", ["domain3.example.com", r"@dom[a]in3\.example"])
+@pytest.mark.parametrize("pipeline", ["1", "4"])
+def test_delete_matching_end_to_end(imap_server, tmp_path, pattern, pipeline):
+    path = tmp_path / "patterns.txt"
+    path.write_text(pattern + "\n")
+    expected = {msg.uid for msg in imap_server.mailbox.messages if "\\Seen" not in msg.flags and "@domain3." in msg.sender}
+    assert expected
+
+    output = run_cli(
+        imap_server, "--pipeline", pipeline, "delete-matching", "-f", str(path), "--allow-all", "--no-progress", "--batch-size", "3"
+    )
+    assert f"Total emails deleted: {len(expected)}" in click.unstyle(output)
+    assert not expected & {msg.uid for msg in imap_server.mailbox.messages}
+
+
+def test_delete_matching_interactive(imap_server, tmp_path, monkeypatch):
+    path = tmp_path / "patterns.txt"
+    path.write_text("domain3.example.com\n")
+    remaining = []
+
+    def confirm(text):
+        remaining.append(len(imap_server.mailbox.messages))
+        return True
+
+    monkeypatch.setattr(click, "confirm", confirm)
+    output = run_cli(imap_server, "delete-matching", "-f", str(path), "--no-progress")
+    deleted = int(click.unstyle(output).rsplit(": ", 1)[1])
+    # Every confirmed email was gone by the next prompt
+    assert len(remaining) == deleted > 1
+    assert remaining == list(range(remaining[0], remaining[0] - deleted, -1))
@@ -3,22 +3,38 @@
 # mmm src --images=xxx --videos=xxx
 #
 import argparse
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import hashlib
+import io
+import json
 import logging
+import math
+import pickle
+import sqlite3
+import struct
+import threading
+import time
 import sys
 import os
-from datetime import timedelta
+from datetime import datetime, timedelta
 from time import perf_counter
-from mimetypes import guess_type, init as mt_init
-from typing import Callable, Dict, List
+import mimetypes
+from mimetypes import init as mt_init
+from typing import Any, Callable, Dict, Iterable, Iterator, List, TextIO, Tuple
 from xml.etree import ElementTree
 from pathlib import Path
-from itertools import islice
 import shutil
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import trio
 import requests
 import humanize
+from tqdm import tqdm
 
 from everyday_scripts.scriptlib import logging_init, sig_quit_clean
 
@@ -28,10 +44,23 @@ Example:
 
   mmm ~/Pictures image=~/Dropbox/images video=~/NAS/videos
 
-DST_PATTERN is TYPE:DIRECTORY, where TYPE comes from the mimetype TYPE/SUBTYPE of every file.
+DST_PATTERN is TYPE=DIRECTORY, where TYPE comes from the mimetype TYPE/SUBTYPE of every file.
 e.g. JPEG files have the mime-type 'image/jpeg'. Here the TYPE is 'image'.
 
+A destination directory can contain {year}, {month} and {day} fields, e.g. image=~/photos/{year}/{month}.
+Files then go into the directory for the date they were taken on, as per EXIF or video metadata, instead
+of mirroring SOURCE_DIR.
+
+With --plan, the work is written to a plan file instead, which can be reviewed, split into ranges of
+entries with --lines, and executed later with --apply, without walking SOURCE_DIR again.
+
+A destination can be given its own concurrency limit as TYPE=DIRECTORY@LIMIT, e.g. video=~/NAS@2. Without
+one, it can use all --parallel operations.
+
 Directory structure of every file under SOURCE_DIR will be preserved.
+
+Completed transfers are logged in a .mmm-journal file in every destination. An interrupted run can be
+continued with --resume, which skips the files already done.
 """
 EXTERNAL_MIMETYPE_SRC = "https://raw.githubusercontent.com/ImageMagick/ImageMagick/main/config/mime.xml"
 MIME_TYPES_FN = "mime.types"
@@ -40,103 +69,1480 @@ EXTRA_EXT_TYPES = {
     ".dop": "image",  # dxo correction files
 }
 PARALLELISM = 5
+WALK_THREADS = 8
+PROGRESS_INTERVAL = 1.0  # seconds between progress updates
+LATENCY_BUCKETS = 20  # log2 buckets from <=1ms to >256s
+QUEUE_DEPTH_FACTOR = 4  # pending files buffered per worker
+LARGE_FILE_SIZE = 64 * 1024 * 1024  # files from this size on are scheduled as large
+COPY_BUFFER_SIZE = 1024 * 1024
+WATCH_DEBOUNCE = 2.0  # seconds without events before a new file is picked up
+# inotify(7) event flags
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+INOTIFY_EVENT_SIZE = 16  # struct inotify_event without the name
+DATES_CACHE_FN = "dates.sqlite"
+EXIF_IFD_POINTER = 0x8769
+EXIF_DATETIME_ORIGINAL = 0x9003
+TIFF_DATETIME = 0x0132
+MAX_IFD_ENTRIES = 1000
+MAX_EXIF_ASCII = 64  # date values are 20 bytes, larger counts are corrupt
+MP4_EPOCH_OFFSET = 2082844800  # seconds from 1904-01-01 to 1970-01-01
+FICLONE = 0x40049409  # _IOW(0x94, 9, int) from linux/fs.h
+JOURNAL_FN = ".mmm-journal"
+HASH_INDEX_FN = ".mmm-hashes"
+DEDUPE_PARTIAL_BYTES = 64 * 1024
+EXT_TYPES_CACHE_FN = "ext_types.pickle"
+EXT_TYPES: Dict[str, str] = {}  # lowercased extension -> type, see init_mimetypes()
+_thread_state = threading.local()
+SNIFF_CACHE_FN = "sniff.sqlite"
+SNIFF_BYTES = 4096
+MAGIC_SIGNATURES = [  # (offset, magic, type)
+    (0, b"\xff\xd8\xff", "image"),  # JPEG
+    (0, b"\x89PNG\r\n\x1a\n", "image"),
+    (0, b"GIF87a", "image"),
+    (0, b"GIF89a", "image"),
+    (0, b"II*\x00", "image"),  # TIFF, and raw formats based on it (CR2, NEF, ARW, DNG)
+    (0, b"MM\x00*", "image"),
+    (0, b"IIRO", "image"),  # Olympus ORF
+    (0, b"IIU\x00", "image"),  # Panasonic RW2
+    (0, b"FUJIFILMCCD-RAW", "image"),  # Fuji RAF
+    (0, b"8BPS", "image"),  # Photoshop
+    (0, b"BM", "image"),
+    (0, b"\x1aE\xdf\xa3", "video"),  # Matroska/WebM
+    (0, b"\x00\x00\x01\xba", "video"),  # MPEG program stream
+    (0, b"\x00\x00\x01\xb3", "video"),  # MPEG video
+    (0, b"FLV\x01", "video"),
+    (0, b"0&\xb2u\x8ef\xcf\x11", "video"),  # ASF/WMV
+    (0, b"ID3", "audio"),  # MP3 with ID3 tag
+    (0, b"\xff\xfb", "audio"),  # MP3 frame
+    (0, b"\xff\xf3", "audio"),
+    (0, b"\xff\xf1", "audio"),  # AAC ADTS
+    (0, b"fLaC", "audio"),
+    (0, b"OggS", "audio"),
+    (0, b"#!AMR", "audio"),
+]
+FTYP_BRANDS = {  # ISO base media major brands that are not video
+    b"heic": "image",
+    b"heix": "image",
+    b"heim": "image",
+    b"heis": "image",
+    b"mif1": "image",
+    b"msf1": "image",
+    b"avif": "image",
+    b"crx ": "image",  # Canon CR3
+    b"M4A ": "audio",
+    b"M4B ": "audio",
+    b"M4P ": "audio",
+}
+RIFF_FORMATS = {
+    b"WEBP": "image",
+    b"AVI ": "video",
+    b"WAVE": "audio",
+}
 
 
 class Metrics:
     moves = 0
     copies = 0
     errors = 0
+    skipped = 0
+    duplicates = 0
+    completed = 0
+    bytes = 0
+    in_flight = 0
     type_counts: dict = defaultdict(int)
+    latencies: dict = defaultdict(lambda: [0] * LATENCY_BUCKETS)  # action -> counts per log2(ms) bucket
+
+    @classmethod
+    def record(cls, action: str, ftype: str):
+        if action == "copy":
+            cls.copies += 1
+        else:
+            cls.moves += 1
+        cls.type_counts[ftype] += 1
+
+    @classmethod
+    def observe(cls, action: str, seconds: float, size: int):
+        """Account for a finished transfer"""
+        cls.completed += 1
+        cls.bytes += size
+        bucket = math.ceil(math.log2(max(seconds * 1000, 1)))
+        cls.latencies[action][min(bucket, LATENCY_BUCKETS - 1)] += 1
+
+    @classmethod
+    def latency_histogram(cls, action: str) -> Dict[str, int]:
+        """Non-empty latency buckets of action, labeled by their upper bound"""
+        histogram = {}
+        for bucket, count in enumerate(cls.latencies[action]):
+            if count:
+                label = f"<={2**bucket}ms" if bucket < LATENCY_BUCKETS - 1 else f">{2 ** (bucket - 1)}ms"
+                histogram[label] = count
+        return histogram
 
     @classmethod
     def stats(cls):
         print("\nSTATS:")
-        for attr in ["moves", "copies", "errors"]:
+        for attr in ["moves", "copies", "errors", "skipped", "duplicates"]:
             print(f"  - {attr:5}\t: {cls.__dict__[attr]:5}")
+        print(f"  - bytes\t: {humanize.naturalsize(cls.bytes, binary=True)}")
         print("  - types\t:")
         for k in sorted(cls.type_counts.keys()):
             print(f"  \t- {k}\t: {cls.type_counts[k]:5}")
+        for action in sorted(cls.latencies.keys()):
+            print(f"  - {action} latency\t:")
+            for label, count in cls.latency_histogram(action).items():
+                print(f"  \t- {label:>9}\t: {count:5}")
+
+
+class Progress:
+    """
+    Live view of Metrics while a run is going: a tqdm bar and/or a JSON lines stream of snapshots.
+
+    Rates in a snapshot are over the interval since the previous snapshot.
+    """
+
+    def __init__(self, bar: bool = False, stream: TextIO | None = None, interval: float = PROGRESS_INTERVAL):
+        self.bar: tqdm | None = tqdm(unit="file", dynamic_ncols=True) if bar else None
+        self.stream = stream
+        self.interval = interval
+        self.start = self.last_time = perf_counter()
+        self.last_completed = self.last_bytes = 0
+
+    def snapshot(self, queue_depth: int) -> dict:
+        now = perf_counter()
+        period = max(now - self.last_time, 1e-9)
+        snap = dict(
+            time=round(time.time(), 3),
+            elapsed=round(now - self.start, 3),
+            files=Metrics.completed,
+            bytes=Metrics.bytes,
+            files_per_s=round((Metrics.completed - self.last_completed) / period, 2),
+            bytes_per_s=round((Metrics.bytes - self.last_bytes) / period),
+            errors=Metrics.errors,
+            skipped=Metrics.skipped,
+            duplicates=Metrics.duplicates,
+            in_flight=Metrics.in_flight,
+            queue_depth=queue_depth,
+            types=dict(Metrics.type_counts),
+            latency_ms={action: Metrics.latency_histogram(action) for action in Metrics.latencies},
+        )
+        self.last_time, self.last_completed, self.last_bytes = now, Metrics.completed, Metrics.bytes
+        return snap
+
+    def update(self, queue_depth: int):
+        snap = self.snapshot(queue_depth)
+        if self.bar is not None:
+            self.bar.n = snap["files"]
+            self.bar.set_postfix(
+                rate=f"{humanize.naturalsize(snap['bytes_per_s'], binary=True)}/s", in_flight=snap["in_flight"], queued=queue_depth
+            )
+        if self.stream:
+            self.stream.write(json.dumps(snap) + "\n")
+            self.stream.flush()
+
+    async def run(self, queue_depth: Callable[[], int]):
+        while True:
+            await trio.sleep(self.interval)
+            self.update(queue_depth())
 
+    def close(self):
+        self.update(0)
+        if self.bar is not None:
+            self.bar.close()
+        if self.stream and self.stream not in (sys.stdout, sys.stderr):
+            self.stream.close()
 
-def init_mimetypes():
+
+def open_stats_stream(spec: str) -> TextIO:
+    """Open the --stats-file target: a file descriptor number, '-' for stdout, or a file path to append to"""
+    if spec == "-":
+        return sys.stdout
+    if spec.isdigit():
+        # The descriptor is inherited from the caller, e.g. 3>stats.log, so it stays open after close()
+        return os.fdopen(int(spec), "w", buffering=1, closefd=False)
+    return open(spec, "a", buffering=1)
+
+
+def cache_dir() -> str:
+    return os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "mmm")
+
+
+def init_mimetypes() -> Dict[str, str]:
+    """
+    Build the flat extension -> type lookup table used for type detection.
+
+    The table merges the mimetypes database (system files plus the mime.types we find) with EXTRA_EXT_TYPES.
+    It is cached as a pickle, keyed by the paths and mtimes of its sources, so that later runs skip parsing.
+    """
     search_paths = [MIME_TYPES_FN, os.path.join(str(Path(__file__).resolve().parent), MIME_TYPES_FN)]  # current dir
-    for path in search_paths:
-        if os.path.exists(path):
-            logging.debug("Using %s for type detection", path)
-            mt_init([path])
-            return
+    mime_types_path = next((path for path in search_paths if os.path.exists(path)), None)
+    sources = [path for path in mimetypes.knownfiles if os.path.exists(path)]
+    if mime_types_path:
+        logging.debug("Using %s for type detection", mime_types_path)
+        sources.append(os.path.abspath(mime_types_path))
+    cache_key = [(path, os.stat(path).st_mtime_ns) for path in sources] + sorted(EXTRA_EXT_TYPES.items())
+    cache_path = os.path.join(cache_dir(), EXT_TYPES_CACHE_FN)
+
+    table = load_ext_types(cache_path, cache_key)
+    if table is None:
+        mt_init([mime_types_path] if mime_types_path else None)
+        table = {}
+        for ext, mtype in mimetypes.types_map.items():
+            table.setdefault(ext.lower(), mtype.split("/")[0].lower())
+        for ext, ftype in EXTRA_EXT_TYPES.items():
+            table.setdefault(ext.lower(), ftype.lower())
+        save_ext_types(cache_path, cache_key, table)
+
+    EXT_TYPES.clear()
+    EXT_TYPES.update(table)
+    return EXT_TYPES
+
+
+def load_ext_types(cache_path: str, cache_key: list) -> Dict[str, str] | None:
+    try:
+        with open(cache_path, "rb") as fp:
+            cached = pickle.load(fp)
+        if cached["key"] == cache_key:
+            logging.debug("Loaded %d extension types from %s", len(cached["table"]), cache_path)
+            return cached["table"]
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.debug("Ignoring unreadable cache %s: %s", cache_path, e)
+    return None
+
+
+def save_ext_types(cache_path: str, cache_key: list, table: Dict[str, str]):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}"
+        with open(tmp_path, "wb") as fp:
+            pickle.dump(dict(key=cache_key, table=table), fp)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logging.debug("Could not write cache %s: %s", cache_path, e)
+
+
+def ext_types() -> Dict[str, str]:
+    return EXT_TYPES or init_mimetypes()
 
 
 def type_for_file(path: str) -> str | None:
-    ftype = guess_type(path)[0]
-    if ftype:
-        return ftype.split("/")[0].lower()
-    _, ext = os.path.splitext(path)
-    if ext.lower() in EXTRA_EXT_TYPES:
-        return EXTRA_EXT_TYPES[ext.lower()].lower()
+    return ext_types().get(os.path.splitext(path)[1].lower())
+
+
+class SqliteCache:
+    """
+    Persistent key -> value store in a SQLite file, safe to share between threads.
+
+    Writes are committed in batches, and on close().
+    """
+
+    def __init__(self, path: str, commit_every: int = 1000):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.lock = threading.Lock()
+        self.commit_every = commit_every
+        self.pending = 0
+
+    def get(self, key: str) -> str | None:
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, value: str):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)", (key, value))
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.conn.commit()
+                self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+def stat_key(st: os.stat_result) -> str:
+    """Cache key identifying one version of a file"""
+    return f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+
+
+def type_for_header(header: bytes) -> str | None:
+    """
+    Guess the type of a file from its first few bytes
+
+    >>> type_for_header(b"\\xff\\xd8\\xff\\xe1")
+    'image'
+    >>> type_for_header(b"\\x00\\x00\\x00\\x18ftypmp42")
+    'video'
+    """
+    for offset, magic, ftype in MAGIC_SIGNATURES:
+        if header.startswith(magic, offset):
+            return ftype
+    if header[4:8] == b"ftyp":
+        # ISO base media file, told apart by the major brand
+        return FTYP_BRANDS.get(header[8:12], "video")
+    if header[:4] == b"RIFF":
+        return RIFF_FORMATS.get(header[8:12])
+    if len(header) > 188 and header[0] == 0x47 and header[188] == 0x47:
+        return "video"  # MPEG transport stream
     return None
 
 
-def find_files(src: str, dest_map: Dict[str, str]):
+class Sniffer:
+    """
+    Detects the type of files by their content, remembering the result per (device, inode, size, mtime).
+
+    A repeat run on the same files costs one stat per file and never reads the file again.
+    """
+
+    def __init__(self, cache: SqliteCache | None = None):
+        self.cache = cache
+
+    def __call__(self, path: str) -> str | None:
+        try:
+            st = os.stat(path)
+            key = stat_key(st)
+            if self.cache:
+                cached = self.cache.get(key)
+                if cached is not None:
+                    return cached or None
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                header = os.pread(fd, SNIFF_BYTES, 0)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logging.debug("Could not sniff %s: %s", path, e)
+            return None
+
+        ftype = type_for_header(header)
+        if self.cache:
+            self.cache.put(key, ftype or "")
+        return ftype
+
+    def close(self):
+        if self.cache:
+            self.cache.close()
+
+
+def scan_dir(path: str) -> Tuple[str, List[str], List[str]]:
+    """
+    List one directory, returning tuple(path, files, subdirs).
+
+    Uses the type information from the DirEntry, so that no extra stat is needed. Like os.walk, symlinks to
+    directories are not followed, and errors are ignored.
+    """
+    files, subdirs = [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                        continue
+                except OSError:
+                    pass
+                files.append(entry.name)
+    except OSError as e:
+        logging.debug("Could not list %s: %s", path, e)
+    return path, files, subdirs
+
+
+def walk_tree(top: str, threads: int = WALK_THREADS) -> Iterator[Tuple[str, List[str]]]:
+    """
+    Generator yielding tuple(dirpath, files) for every directory under top.
+
+    Subdirectories are listed concurrently by a pool of threads, which hides the latency of every readdir on
+    network mounts. Directories are yielded as soon as they are listed, in no particular order.
+    """
+    if threads <= 1:
+        stack = [top]
+        while stack:
+            path, files, subdirs = scan_dir(stack.pop())
+            stack.extend(reversed(subdirs))
+            yield path, files
+        return
+
+    pool = ThreadPoolExecutor(threads, thread_name_prefix="walk")
+    try:
+        pending = {pool.submit(scan_dir, top)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, files, subdirs = future.result()
+                pending.update(pool.submit(scan_dir, d) for d in subdirs)
+                yield path, files
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def parse_exif_date(value: bytes) -> datetime | None:
+    try:
+        return datetime.strptime(value.rstrip(b"\0 ").decode("ascii"), "%Y:%m:%d %H:%M:%S")
+    except ValueError:
+        return None  # e.g. "0000:00:00 00:00:00" from cameras without a clock
+
+
+def read_ifd(fd: int, base: int, offset: int, endian: str) -> Dict[int, Tuple[int, bytes]]:
+    """Entries of the TIFF IFD at offset, as tag -> tuple(count, raw 4 byte value/offset)"""
+    (count,) = struct.unpack(endian + "H", os.pread(fd, 2, base + offset))
+    data = os.pread(fd, min(count, MAX_IFD_ENTRIES) * 12, base + offset + 2)
+    entries = {}
+    for pos in range(0, len(data) - 11, 12):
+        tag, _, n = struct.unpack_from(endian + "HHI", data, pos)
+        entries[tag] = (n, data[pos + 8 : pos + 12])
+    return entries
+
+
+def tiff_date(fd: int, base: int) -> datetime | None:
+    """DateTimeOriginal (or DateTime) from the TIFF structure at base, which is where EXIF data lives too"""
+    header = os.pread(fd, 8, base)
+    endian = {b"II": "<", b"MM": ">"}.get(header[:2])
+    if endian is None or len(header) < 8:
+        return None
+    size = os.fstat(fd).st_size
+
+    def ascii_value(entry: Tuple[int, bytes]) -> bytes:
+        count, raw = entry
+        if count <= 4:
+            return raw[:count]
+        offset = base + struct.unpack(endian + "I", raw)[0]
+        if count > MAX_EXIF_ASCII or offset + count > size:
+            return b""
+        return os.pread(fd, count, offset)
+
+    ifd0 = read_ifd(fd, base, struct.unpack(endian + "I", header[4:8])[0], endian)
+    if EXIF_IFD_POINTER in ifd0:
+        exif = read_ifd(fd, base, struct.unpack(endian + "I", ifd0[EXIF_IFD_POINTER][1])[0], endian)
+        if EXIF_DATETIME_ORIGINAL in exif:
+            if date := parse_exif_date(ascii_value(exif[EXIF_DATETIME_ORIGINAL])):
+                return date
+    if TIFF_DATETIME in ifd0:
+        return parse_exif_date(ascii_value(ifd0[TIFF_DATETIME]))
+    return None
+
+
+def jpeg_date(fd: int) -> datetime | None:
+    """Walks the JPEG segment headers up to the EXIF APP1 segment, and parses only that"""
+    offset = 2
+    while True:
+        header = os.pread(fd, 10, offset)
+        if len(header) < 4 or header[0] != 0xFF or header[1] in (0xD9, 0xDA):  # end of image, start of scan
+            return None
+        if header[1] == 0xE1 and header[4:10] == b"Exif\0\0":
+            return tiff_date(fd, offset + 10)
+        offset += 2 + struct.unpack(">H", header[2:4])[0]
+
+
+def find_box(fd: int, start: int, end: int, box_type: bytes) -> Tuple[int, int] | None:
+    """Finds an ISO media box between start and end, returning tuple(payload offset, box end)"""
+    offset = start
+    while offset + 8 <= end:
+        header = os.pread(fd, 16, offset)
+        if len(header) < 8:
+            return None
+        size, name = struct.unpack(">I4s", header[:8])
+        header_size = 8
+        if size == 1:
+            (size,) = struct.unpack(">Q", header[8:16])
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            return None
+        if name == box_type:
+            return offset + header_size, offset + size
+        offset += size
+    return None
+
+
+def mp4_date(fd: int, size: int) -> datetime | None:
+    """Creation time from the movie header (moov/mvhd), seeking over all other boxes"""
+    moov = find_box(fd, 0, size, b"moov")
+    mvhd = moov and find_box(fd, moov[0], moov[1], b"mvhd")
+    if not mvhd:
+        return None
+    data = os.pread(fd, 12, mvhd[0])
+    if len(data) < 12:
+        return None
+    created = struct.unpack(">Q", data[4:12])[0] if data[0] == 1 else struct.unpack(">I", data[4:8])[0]
+    if created <= MP4_EPOCH_OFFSET:
+        return None  # unset
+    return datetime.fromtimestamp(created - MP4_EPOCH_OFFSET)
+
+
+def media_date(path: str, cache: SqliteCache | None = None) -> datetime:
+    """
+    When a photo or video was taken, from EXIF or the MP4/QuickTime movie header, or else the file mtime.
+
+    Only the few header bytes needed are read, and results are cached per file version. Corrupt or truncated
+    headers fall back to the mtime, and only an OSError from stat'ing the file is raised.
+    """
+    st = os.stat(path)
+    key = stat_key(st)
+    if cache:
+        cached = cache.get(key)
+        if cached is not None:
+            return datetime.fromisoformat(cached)
+
+    date = None
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            magic = os.pread(fd, 12, 0)
+            if magic.startswith(b"\xff\xd8\xff"):
+                date = jpeg_date(fd)
+            elif magic[:4] in (b"II*\x00", b"MM\x00*"):
+                date = tiff_date(fd, 0)
+            elif magic[4:8] == b"ftyp":
+                date = mp4_date(fd, st.st_size)
+        finally:
+            os.close(fd)
+    except (OSError, struct.error, ValueError, OverflowError) as e:
+        # ValueError and OverflowError are out of range timestamps
+        logging.debug("Could not read the date of %s: %s", path, e)
+    if date is None:
+        date = datetime.fromtimestamp(st.st_mtime)
+
+    if cache:
+        cache.put(key, date.isoformat())
+    return date
+
+
+def template_root(dst: str) -> str:
+    """
+    The fixed directory part of a destination template
+
+    >>> template_root("/photos/{year}/{month}")
+    '/photos'
+    >>> template_root("/photos")
+    '/photos'
+    """
+    if "{" not in dst:
+        return dst
+    return dst[: max(1, dst.rfind("/", 0, dst.index("{")))]
+
+
+class PathMapper:
+    """
+    Maps the files found under src to their destination paths.
+
+    Paths from the walk all start with src, so by default the mapping is a plain string prefix replacement,
+    without any syscall. With resolve_symlinks, every file is resolved first and placed according to where
+    its target lives, at the cost of several lstat/readlink calls per file.
+
+    Destinations can also be templates with {year}, {month} and {day} fields, e.g. /photos/{year}/{month}.
+    Files then go straight into the directory for the date they were taken on (see media_date()), and the
+    workers keep files with the same name and date apart (see claim_path()).
+    """
+
+    def __init__(self, src: str, dest_map: Dict[str, str], resolve_symlinks: bool = False, dates: SqliteCache | None = None):
+        self.src = src
+        self.dest_map = dest_map
+        self.resolve_symlinks = resolve_symlinks
+        self.dates = dates
+
+    def __call__(self, path: str, ftype: str) -> str:
+        dst = self.dest_map[ftype]
+        if "{" in dst:
+            date = media_date(path, self.dates)
+            return os.path.join(dst.format(year=f"{date.year:04}", month=f"{date.month:02}", day=f"{date.day:02}"), os.path.basename(path))
+        return replace_path(path, self.src, dst, self.resolve_symlinks)
+
+    @property
+    def uses_templates(self) -> bool:
+        return any("{" in dst for dst in self.dest_map.values())
+
+
+def find_files(src: str, dest_map: Dict[str, str], walk_threads: int = WALK_THREADS):
     """
     Generator to find files and types
 
     Given a path to search, returns a list of tuple(origin_path, destination_root)
     """
-    for root, _, files in os.walk(src):
+    for full_path, final_path, _ in find_typed_files(src, dest_map, walk_threads):
+        yield (full_path, final_path)
+
+
+def find_typed_files(
+    src: str,
+    dest_map: Dict[str, str],
+    walk_threads: int = WALK_THREADS,
+    sniffer: Sniffer | None = None,
+    mapper: PathMapper | None = None,
+):
+    """
+    Same as find_files, but yields tuple(origin_path, destination_path, type)
+
+    Files with an unknown extension are classified by content if a sniffer is given.
+    """
+    if mapper is None:
+        mapper = PathMapper(src, dest_map)
+    for root, files in walk_tree(src, walk_threads):
         for f in files:
-            full_path = os.path.join(root, f)
-            ftype = type_for_file(f)
-            if ftype is not None:
-                if ftype in dest_map:
-                    final_path = replace_path(full_path, src, dest_map[ftype])
-                    Metrics.type_counts[ftype] += 1
-                    yield (full_path, final_path)
-            else:
-                logging.debug("Skipping file with unknown file type: %s", full_path)
+            item = classify_file(os.path.join(root, f), dest_map, mapper, sniffer)
+            if item is not None:
+                yield item
+
+
+def classify_file(
+    full_path: str, dest_map: Dict[str, str], mapper: PathMapper, sniffer: Sniffer | None = None
+) -> Tuple[str, str, str] | None:
+    """Returns tuple(origin_path, destination_path, type) for a file, or None if it has no destination"""
+    ftype = ext_types().get(os.path.splitext(full_path)[1].lower())
+    if ftype is None and sniffer is not None:
+        ftype = sniffer(full_path)
+    if ftype is None:
+        logging.debug("Skipping file with unknown file type: %s", full_path)
+        return None
+    if ftype not in dest_map:
+        return None
+    try:
+        return (full_path, mapper(full_path, ftype), ftype)
+    except ValueError as e:
+        logging.warning("Skipping file outside the source directory: %s", e)
+        return None
+    except OSError as e:
+        # e.g. deleted while walking
+        logging.warning("Skipping file that could not be read: %s", e)
+        return None
+
+
+class Journal:
+    """
+    Append-only log of completed transfers, kept as JSON lines in a destination root.
+
+    Every line records (action, src, dst, size, mtime, type) of one finished move/copy. On --resume the
+    journal is loaded into a dict keyed by source path, so that finished work is skipped with a single
+    lookup, and its counts are added back to Metrics.
+
+    The journal is never truncated: it is opened with O_APPEND and every entry is a single write, so that runs
+    applying different --lines of one plan at the same time all add to it.
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self.done: Dict[str, dict] = {}
+        if resume and os.path.exists(path):
+            self.load()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        size = os.fstat(self.fd).st_size
+        if size and os.pread(self.fd, 1, size - 1) != b"\n":
+            # Terminate a partially written last line from a crash
+            os.write(self.fd, b"\n")
+
+    def load(self):
+        with open(self.path) as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Partially written last line from a crash
+                    logging.debug("Ignoring invalid journal line in %s: %r", self.path, line)
+                    continue
+                self.done[entry["src"]] = entry
+        # A file transferred again in a later run has several lines, but counts once
+        for entry in self.done.values():
+            Metrics.record(entry["action"], entry["type"])
+        logging.info("Resuming from %s with %d completed files", self.path, len(self.done))
+
+    def is_done(self, src: str, dst: str, st: os.stat_result) -> bool:
+        entry = self.done.get(src)
+        return entry is not None and entry["dst"] == dst and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime_ns
+
+    def record(self, action: str, src: str, dst: str, ftype: str, st: os.stat_result, final: str | None = None):
+        entry = dict(action=action, src=src, dst=dst, size=st.st_size, mtime=st.st_mtime_ns, type=ftype)
+        if final is not None and final != dst:
+            # Renamed to avoid a collision, see claim_path()
+            entry["final"] = final
+        os.write(self.fd, (json.dumps(entry) + "\n").encode())
+
+    def close(self):
+        os.close(self.fd)
+
+
+class TransferQueue:
+    """
+    Bounded queue of the files going to one destination, interleaving small and large files.
+
+    When both are waiting, workers alternate between small and large files. At most max_large large files are
+    transferred at a time, so that with two or more workers small files never wait behind large ones.
+    """
+
+    def __init__(self, capacity: int, workers: int):
+        self.small: deque = deque()
+        self.large: deque = deque()
+        self.capacity = capacity
+        self.max_large = max(1, workers - 1)
+        self.large_in_flight = 0
+        self.prefer_small = True
+        self.closed = False
+        self.changed = trio.Condition()
+
+    def __len__(self) -> int:
+        return len(self.small) + len(self.large)
+
+    async def put(self, item, large: bool):
+        async with self.changed:
+            while len(self) >= self.capacity:
+                await self.changed.wait()
+            (self.large if large else self.small).append(item)
+            self.changed.notify_all()
+
+    async def get(self) -> Tuple[Any, bool] | None:
+        """Next tuple(item, large) to transfer, or None once the queue is closed and drained"""
+        async with self.changed:
+            while True:
+                can_large = bool(self.large) and self.large_in_flight < self.max_large
+                if self.small and (self.prefer_small or not can_large):
+                    self.prefer_small = False
+                    self.changed.notify_all()
+                    return self.small.popleft(), False
+                if can_large:
+                    self.prefer_small = True
+                    self.large_in_flight += 1
+                    self.changed.notify_all()
+                    return self.large.popleft(), True
+                if self.closed and not self:
+                    return None
+                await self.changed.wait()
+
+    async def done_large(self):
+        async with self.changed:
+            self.large_in_flight -= 1
+            self.changed.notify_all()
+
+    async def close(self):
+        async with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+
+
+class DirCache:
+    """
+    Remembers the directories already created, so that each one costs a single makedirs per run.
+
+    Safe to share between threads.
+    """
+
+    def __init__(self):
+        self.created: set = set()
+        self.lock = threading.Lock()
+
+    def ensure(self, path: str):
+        if path in self.created:
+            return
+        with self.lock:
+            if path not in self.created:
+                os.makedirs(path, exist_ok=True)
+                self.created.add(path)
+
 
+class Destination:
+    """State shared by all the files going to one destination root"""
 
-async def move_a_file(src: str, dst: str, args: argparse.Namespace):
+    def __init__(self, path: str, same_fs: bool, limit: int = PARALLELISM, templated: bool = False):
+        self.path = path
+        self.same_fs = same_fs
+        self.limit = limit
+        # Files from different source directories can map to the same path, see claim_path()
+        self.templated = templated
+        self.queue = TransferQueue(limit * QUEUE_DEPTH_FACTOR, limit)
+        self.journal: Journal | None = None
+        self.hashes: SqliteCache | None = None
+        self.dirs: DirCache | None = None
+
+    def open_journal(self, resume: bool):
+        self.journal = Journal(os.path.join(self.path, JOURNAL_FN), resume)
+
+    def open_hashes(self):
+        self.hashes = SqliteCache(os.path.join(self.path, HASH_INDEX_FN))
+
+    def close(self):
+        if self.journal:
+            self.journal.close()
+        if self.hashes:
+            self.hashes.close()
+
+
+def file_digest(path: str, st: os.stat_result, partial: bool, hashes: SqliteCache | None = None) -> str:
+    """
+    Hash of the content of a file. A partial hash only covers the first and last DEDUPE_PARTIAL_BYTES.
+
+    Hashes are remembered in hashes, keyed by path and the identity of the file version.
+    """
+    key = f"{'partial' if partial else 'full'}:{path}:{stat_key(st)}"
+    if hashes:
+        cached = hashes.get(key)
+        if cached is not None:
+            return cached
+
+    with open(path, "rb") as fp:
+        if partial:
+            h = hashlib.blake2b(os.pread(fp.fileno(), DEDUPE_PARTIAL_BYTES, 0))
+            if st.st_size > DEDUPE_PARTIAL_BYTES:
+                tail_offset = max(DEDUPE_PARTIAL_BYTES, st.st_size - DEDUPE_PARTIAL_BYTES)
+                h.update(os.pread(fp.fileno(), DEDUPE_PARTIAL_BYTES, tail_offset))
+        else:
+            h = hashlib.file_digest(fp, hashlib.blake2b)
+    digest = h.hexdigest()
+    if hashes:
+        hashes.put(key, digest)
+    return digest
+
+
+def identical_files(src: str, dst: str, hashes: SqliteCache | None = None, trust_mtime: bool = True) -> bool:
+    """
+    Check whether dst already has the same content as src, doing the cheapest checks first.
+
+    Sizes must match. Matching mtimes are then taken as proof, like rsync does, unless trust_mtime is False
+    because src is deleted when it matches. Otherwise the partial hashes are compared, and only if they match
+    are the files hashed in full.
+    """
+    try:
+        src_st = os.stat(src)
+        dst_st = os.stat(dst)
+    except FileNotFoundError:
+        return False
+    if src_st.st_size != dst_st.st_size:
+        return False
+    if trust_mtime and src_st.st_mtime_ns == dst_st.st_mtime_ns:
+        return True
+    if file_digest(src, src_st, True, hashes) != file_digest(dst, dst_st, True, hashes):
+        return False
+    if src_st.st_size <= 2 * DEDUPE_PARTIAL_BYTES:
+        return True  # the partial hash covered the whole file
+    return file_digest(src, src_st, False, hashes) == file_digest(dst, dst_st, False, hashes)
+
+
+def claim_path(src: str, dst: str, hashes: SqliteCache | None = None, dirs: DirCache | None = None, trust_mtime: bool = True) -> str | None:
+    """
+    Reserve a path for src at a destination where files from different directories can collide, like
+    /photos/{year}/{month} does for two IMG_0001.JPG taken the same month.
+
+    An empty placeholder is created with O_EXCL at dst, or else at the first free one of dst-1, dst-2...
+    (IMG_0001-1.JPG), so that no worker ever overwrites a file. Returns None instead if one of the taken
+    paths already has the content of src. Placeholders of transfers still in flight never compare equal, so
+    identical files transferred at the same time can both be kept, under different names.
+    """
+    make_parent(dst, dirs)
+    base, ext = os.path.splitext(dst)
+    path, n = dst, 0
+    while True:
+        try:
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+            return path
+        except FileExistsError:
+            if identical_files(src, path, hashes, trust_mtime):
+                return None
+        n += 1
+        path = f"{base}-{n}{ext}"
+
+
+def prepare_destinations(
+    src: str, dest_map: Dict[str, str], parallel: int = PARALLELISM, limits: Dict[str, int] | None = None
+) -> Dict[str, Destination]:
+    """
+    Set up the Destination for every type. Types sharing a directory share the Destination.
+
+    Whether a destination is on the same device as src is checked once here, so that the per-file path
+    can pick rename/reflink without any extra stat.
+    """
+    limits = limits or {}
+    src_dev = os.stat(src).st_dev
+    roots = {dst: template_root(dst) for dst in dest_map.values()}
+    templated = {root for dst, root in roots.items() if "{" in dst}
+    by_root = {
+        root: Destination(root, os.stat(root).st_dev == src_dev, min(parallel, limits.get(root, parallel)), root in templated)
+        for root in set(roots.values())
+    }
+    return {ftype: by_root[roots[dst]] for ftype, dst in dest_map.items()}
+
+
+def rename_file(src: str, dst: str):
+    """Atomic rename for files on the same filesystem, falling back to shutil.move."""
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # Source sub-tree is on another mount after all
+        shutil.move(src, dst)
+
+
+def fast_copyfile(src: str, dst: str):
+    """
+    Copy src to dst on the same filesystem without moving data through userspace.
+
+    Tries a reflink (FICLONE) first, which is a metadata-only operation on btrfs/XFS, then
+    os.copy_file_range, before falling back to shutil.copyfile (which uses sendfile on Linux).
+    """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        raise shutil.SameFileError(f"{src!r} and {dst!r} are the same file")
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        sfd, dfd = fsrc.fileno(), fdst.fileno()
+        try:
+            fcntl.ioctl(dfd, FICLONE, sfd)
+            return
+        except OSError as e:
+            logging.debug("Reflink not possible for %s: %s", src, e)
+
+        if hasattr(os, "copy_file_range"):
+            try:
+                remaining = os.fstat(sfd).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(sfd, dfd, remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                return
+            except OSError as e:
+                logging.debug("copy_file_range not possible for %s: %s", src, e)
+
+    shutil.copyfile(src, dst)
+
+
+def copy_buffer() -> memoryview:
+    """Copy buffer of the calling thread, allocated once and reused for every file"""
+    if not hasattr(_thread_state, "buffer"):
+        _thread_state.buffer = memoryview(bytearray(COPY_BUFFER_SIZE))
+    return _thread_state.buffer
+
+
+def hash_file(fp: io.RawIOBase, buf: memoryview) -> str:
+    h = hashlib.blake2b()
+    while n := fp.readinto(buf):
+        h.update(buf[:n])
+    return h.hexdigest()
+
+
+def verified_copyfile(src: str, dst: str):
+    """
+    Copy src to dst, checksumming the data as it streams through, then verify dst against the checksum.
+
+    The source is read only once. dst is flushed and dropped from the page cache before it is read back, so
+    that the verification reads what actually landed on the device. A mismatch raises OSError(EIO).
+    """
+    buf = copy_buffer()
+    h = hashlib.blake2b()
+    with open(src, "rb", buffering=0) as fsrc, open(dst, "wb", buffering=0) as fdst:
+        while n := fsrc.readinto(buf):
+            h.update(buf[:n])
+            written = 0
+            while written < n:
+                written += fdst.write(buf[written:n])
+        os.fsync(fdst.fileno())
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fdst.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+    with open(dst, "rb", buffering=0) as fp:
+        dst_digest = hash_file(fp, buf)
+    if dst_digest != h.hexdigest():
+        raise OSError(errno.EIO, f"Checksum mismatch after copying {src!r} to {dst!r}")
+
+
+def verified_move(src: str, dst: str):
+    """Move across filesystems like shutil.move, but only remove src after the copy has been verified"""
+    verified_copyfile(src, dst)
+    shutil.copystat(src, dst)
+    os.unlink(src)
+
+
+async def move_a_file(src: str, dst: str, ftype: str, args: argparse.Namespace, dest: Destination | None = None):
+    same_fs = dest is not None and dest.same_fs
+    journal = dest.journal if dest else None
+    verify = args.verify
     action = "move"
-    method: Callable = shutil.move
+    method: Callable = rename_file if same_fs else verified_move if verify else shutil.move
     if args.copy:
         action = "copy"
-        method = shutil.copyfile
-        Metrics.copies += 1
-    else:
-        Metrics.moves += 1
+        method = fast_copyfile if same_fs else verified_copyfile if verify else shutil.copyfile
+
+    if journal and src in journal.done:
+        try:
+            st = await trio.to_thread.run_sync(os.stat, src)
+            if journal.is_done(src, dst, st):
+                logging.debug("Already done in an earlier run: %s", src)
+                Metrics.skipped += 1
+                return
+        except OSError:
+            pass
+
+    duplicate = False
+    if args.dedupe:
+        try:
+            # A move deletes the duplicate source, so only its content is proof enough
+            duplicate = await trio.to_thread.run_sync(identical_files, src, dst, dest.hashes if dest else None, args.copy)
+        except OSError as e:
+            logging.warning("Could not compare %s with %s: %s", src, dst, e)
+    final = dst
+    if not duplicate and not args.dry_run and dest is not None and dest.templated:
+        try:
+            claimed = await trio.to_thread.run_sync(claim_path, src, dst, dest.hashes, dest.dirs, args.copy)
+        except OSError as e:
+            logging.error("Could not %s %s -> %s: %s", action, src, dst, e)
+            Metrics.errors += 1
+            return
+        duplicate = claimed is None
+        final = claimed or dst
+    if duplicate:
+        Metrics.duplicates += 1
+        if args.dry_run or logging.getLogger().getEffectiveLevel() == logging.INFO:
+            print("[SKIP]", src, "==", dst)
+        if not args.copy and not args.dry_run:
+            # Moving onto an identical file leaves just the destination
+            try:
+                await trio.to_thread.run_sync(os.unlink, src)
+            except OSError as e:
+                logging.error("Could not remove duplicate %s: %s", src, e)
+                Metrics.errors += 1
+        return
+
+    Metrics.record(action, ftype)
 
     if args.dry_run:
         print(f"[{action.upper()}]", src, "->", dst)
     else:
         if logging.getLogger().getEffectiveLevel() == logging.INFO:
-            print(f"[{action.upper()}]", src, "->", dst)
+            print(f"[{action.upper()}]", src, "->", final)
+        Metrics.in_flight += 1
+        start = perf_counter()
         try:
-            Path(dst).parent.mkdir(parents=True, exist_ok=True)
-            method(src, dst)
+            st = await trio.to_thread.run_sync(transfer_file, src, final, method, dest.dirs if dest else None)
         except Exception as e:
-            logging.error("Could not %s %s -> %s: %s", action, src, dst, e)
+            logging.error("Could not %s %s -> %s: %s", action, src, final, e)
             Metrics.errors += 1
+            if dest is not None and dest.templated:
+                # Release the placeholder of claim_path()
+                with contextlib.suppress(OSError):
+                    os.unlink(final)
+            return
+        finally:
+            Metrics.in_flight -= 1
+        Metrics.observe(action, perf_counter() - start, st.st_size)
+        if journal:
+            journal.record(action, src, dst, ftype, st, final)
+
+
+def transfer_file(src: str, dst: str, method: Callable, dirs: DirCache | None = None) -> os.stat_result:
+    """
+    Blocking part of a move/copy. Runs in a worker thread. Returns the stat of src before the transfer.
+
+    Copies get the times of src, like moves keep them, so that identical_files() can match them by mtime.
+    """
+    st = os.stat(src)
+    make_parent(dst, dirs)
+    method(src, dst)
+    try:
+        os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+    except OSError as e:
+        logging.debug("Could not set the times of %s: %s", dst, e)
+    return st
 
 
-async def move_files(src: str, dest_map: Dict[str, str], args: argparse.Namespace):
-    gen = find_files(src, dest_map)
+def make_parent(path: str, dirs: DirCache | None = None):
+    if dirs:
+        dirs.ensure(os.path.dirname(path))
+    else:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+
+def prepare_item(item: Tuple[str, str, str], destinations: Dict[str, Destination], size: int | None = None) -> Tuple[Destination, bool]:
+    """
+    Creates the directory of a file at its destination ahead of the workers, and tells if it is a large file.
+
+    Runs in the walking thread, so that the directory skeleton gets created once, in order, and the
+    workers are left with just the transfers.
+    """
+    dest = destinations[item[2]]
+    if dest.dirs:
+        try:
+            dest.dirs.ensure(os.path.dirname(item[1]))
+        except OSError as e:
+            logging.debug("Could not create the directory for %s: %s", item[1], e)
+    return dest, is_large(item[0]) if size is None else size >= LARGE_FILE_SIZE
+
+
+async def walk_files(
+    src: str,
+    dest_map: Dict[str, str],
+    destinations: Dict[str, Destination],
+    walk_threads: int = WALK_THREADS,
+    sniffer: Sniffer | None = None,
+    mapper: PathMapper | None = None,
+):
+    """
+    Feed the files found under src into the queues of their destinations.
+
+    The walk runs in a thread, and blocks whenever a queue is full, so that memory use stays flat
+    regardless of the size of the tree.
+    """
+
+    def walk():
+        for item in find_typed_files(src, dest_map, walk_threads, sniffer, mapper):
+            dest, large = prepare_item(item, destinations)
+            trio.from_thread.run(dest.queue.put, item, large)
+
+    await trio.to_thread.run_sync(walk)
+
+
+async def feed_items(items: Iterable[Tuple[str, str, str, int]], destinations: Dict[str, Destination]):
+    """Feed tuple(origin_path, destination_path, type, size) items, e.g. from a plan, into the destination queues"""
+
+    def feed():
+        for src, dst, ftype, size in items:
+            item = (src, dst, ftype)
+            dest, large = prepare_item(item, destinations, size)
+            trio.from_thread.run(dest.queue.put, item, large)
+
+    await trio.to_thread.run_sync(feed)
+
+
+def is_large(path: str) -> bool:
+    try:
+        return os.stat(path).st_size >= LARGE_FILE_SIZE
+    except OSError:
+        return False
+
+
+class Inotify:
+    """Minimal inotify(7) binding over ctypes. Linux only."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1: {os.strerror(err)}")
+        self.watches: Dict[int, str] = {}  # watch descriptor -> directory
+
+    def add_watch(self, path: str, mask: int = WATCH_MASK):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_add_watch {path}: {os.strerror(err)}")
+        self.watches[wd] = path
+
+    def read_events(self) -> List[Tuple[str, int]]:
+        """Pending events as a list of tuple(path, mask), without blocking"""
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from("iIII", data, offset)
+            offset += INOTIFY_EVENT_SIZE
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+            elif wd in self.watches or mask & IN_Q_OVERFLOW:
+                events.append((os.path.join(self.watches.get(wd, ""), name), mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+async def watch_files(
+    inotify: Inotify,
+    dest_map: Dict[str, str],
+    destinations: Dict[str, Destination],
+    mapper: PathMapper,
+    sniffer: Sniffer | None = None,
+    debounce: float = WATCH_DEBOUNCE,
+):
+    """
+    Dispatch the files that appear under the watched directories, until cancelled.
+
+    A file is dispatched once no event has been seen for it for debounce seconds, so that files still being
+    written (or rewritten) are left alone. New directories get watched, and files already in them are
+    picked up too.
+    """
+
+    def watch_tree(path: str) -> List[str]:
+        """Watch path and its subdirectories, returning the files already in them"""
+        found = []
+        for root, files in walk_tree(path, 1):
+            try:
+                inotify.add_watch(root)
+            except OSError as e:
+                logging.warning("Could not watch %s: %s", root, e)
+            found.extend(os.path.join(root, f) for f in files)
+        return found
+
+    pending: Dict[str, float] = {}  # path -> time it can be dispatched
     while True:
-        chunk = list(islice(gen, args.parallel))
-        if not chunk:
+        timeout = max(0, min(pending.values()) - trio.current_time()) if pending else math.inf
+        with trio.move_on_after(timeout):
+            await trio.lowlevel.wait_readable(inotify.fd)
+
+        now = trio.current_time()
+        for path, mask in inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                logging.warning("Missed filesystem events, rescanning the watched directories")
+                watched = set(inotify.watches.values())
+                for root in watched:
+                    _, files, subdirs = await trio.to_thread.run_sync(scan_dir, root)
+                    found = [os.path.join(root, f) for f in files]
+                    for subdir in subdirs:
+                        if subdir not in watched:
+                            found.extend(await trio.to_thread.run_sync(watch_tree, subdir))
+                    for f in found:
+                        pending[f] = now + debounce
+                continue
+            if mask & IN_ISDIR:
+                for f in await trio.to_thread.run_sync(watch_tree, path):
+                    pending[f] = now + debounce
+            else:
+                pending[path] = now + debounce
+
+        for path in [p for p, due in pending.items() if due <= now]:
+            del pending[path]
+            if not os.path.isfile(path):
+                continue  # already gone, or picked up by the initial scan
+            item = await trio.to_thread.run_sync(classify_file, path, dest_map, mapper, sniffer)
+            if item is not None:
+                logging.debug("New file: %s", path)
+                dest, large = await trio.to_thread.run_sync(prepare_item, item, destinations)
+                await dest.queue.put(item, large)
+
+
+async def produce_files(
+    src: str,
+    dest_map: Dict[str, str],
+    destinations: Dict[str, Destination],
+    args: argparse.Namespace,
+    mapper: PathMapper,
+    sniffer: Sniffer | None = None,
+    items: Iterable[Tuple[str, str, str, int]] | None = None,
+):
+    """
+    Walk src, and with --watch keep dispatching new files afterwards. The queues are closed when done.
+
+    In watch mode, the directories are watched before the initial walk, so that no file falls in between.
+    If items are given, they are dispatched instead of walking.
+    """
+    walk_threads = args.walk_threads
+    inotify = None
+
+    def watch_dirs(inotify: Inotify):
+        for root, _ in walk_tree(src, walk_threads):
+            inotify.add_watch(root)
+
+    try:
+        if items is not None:
+            await feed_items(items, destinations)
             return
-        async with trio.open_nursery() as nursery:
-            for orig_path, final_path in chunk:
-                nursery.start_soon(move_a_file, orig_path, final_path, args)
+        if args.watch:
+            inotify = Inotify()
+            await trio.to_thread.run_sync(watch_dirs, inotify)
+            logging.info("Watching %d directories under %s", len(inotify.watches), src)
+        await walk_files(src, dest_map, destinations, walk_threads, sniffer, mapper)
+        if inotify:
+            await watch_files(inotify, dest_map, destinations, mapper, sniffer, args.watch_debounce)
+    finally:
+        if inotify:
+            inotify.close()
+        with trio.CancelScope(shield=True):
+            for dest in set(destinations.values()):
+                await dest.queue.close()
+
+
+async def move_worker(dest: Destination, args: argparse.Namespace, limiter: trio.CapacityLimiter):
+    while (got := await dest.queue.get()) is not None:
+        (orig_path, final_path, ftype), large = got
+        try:
+            async with limiter:
+                await move_a_file(orig_path, final_path, ftype, args, dest)
+        finally:
+            if large:
+                await dest.queue.done_large()
+
+
+def make_sniffer(args: argparse.Namespace) -> Sniffer | None:
+    return Sniffer(SqliteCache(os.path.join(cache_dir(), SNIFF_CACHE_FN))) if args.sniff else None
 
 
-def replace_path(path: str, src: str, dst: str) -> str:
+def make_mapper(src: str, dest_map: Dict[str, str], args: argparse.Namespace) -> PathMapper:
+    mapper = PathMapper(src, dest_map, args.resolve_symlinks)
+    if mapper.uses_templates:
+        mapper.dates = SqliteCache(os.path.join(cache_dir(), DATES_CACHE_FN))
+    return mapper
+
+
+async def move_files(
+    src: str,
+    dest_map: Dict[str, str],
+    args: argparse.Namespace,
+    limits: Dict[str, int] | None = None,
+    items: Iterable[Tuple[str, str, str, int]] | None = None,
+):
+    """
+    Move/copy everything under src as per dest_map, or just items if given.
+
+    Every destination has its own queue and its own workers, as many as its limit in limits (if any) or
+    --parallel otherwise. The total number of transfers in flight is capped by --parallel.
+    """
+    parallel = max(1, args.parallel)
+    destinations = prepare_destinations(src, dest_map, parallel, limits)
+    logging.debug("Destinations on the same filesystem as source: %s", {t: d.same_fs for t, d in destinations.items()})
+    unique_destinations = set(destinations.values())
+    if not args.dry_run:
+        for dest in unique_destinations:
+            dest.dirs = DirCache()
+            dest.open_journal(args.resume)
+            if args.dedupe:
+                dest.open_hashes()
+
+    sniffer = make_sniffer(args)
+    mapper = make_mapper(src, dest_map, args)
+
+    progress = None
+    stats_file = args.stats_file
+    if args.progress or stats_file:
+        progress = Progress(args.progress, open_stats_stream(stats_file) if stats_file else None)
+
+    limiter = trio.CapacityLimiter(parallel)
+    try:
+        async with trio.open_nursery() as outer:
+            if progress:
+                outer.start_soon(progress.run, lambda: sum(len(d.queue) for d in unique_destinations))
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(produce_files, src, dest_map, destinations, args, mapper, sniffer, items)
+                for dest in unique_destinations:
+                    for _ in range(dest.limit):
+                        nursery.start_soon(move_worker, dest, args, limiter)
+            outer.cancel_scope.cancel()
+    finally:
+        for dest in unique_destinations:
+            dest.close()
+        if sniffer:
+            sniffer.close()
+        if mapper.dates:
+            mapper.dates.close()
+        if progress:
+            progress.close()
+
+
+def write_plan(src: str, dest_map: Dict[str, str], limits: Dict[str, int], args: argparse.Namespace, path: str) -> int:
+    """
+    Write what a run would do to a plan file, without doing it. Returns the number of files planned.
+
+    The first line is a '#' comment with the source, destinations and options as JSON. Every other line
+    is a JSON array of [action, size, type, src, dst] for one file, so that plans can be streamed, reviewed
+    and split by line ranges.
+    """
+    action = "copy" if args.copy else "move"
+    sniffer = make_sniffer(args)
+    mapper = make_mapper(src, dest_map, args)
+    count = 0
+    try:
+        with open(path, "w") if path != "-" else contextlib.nullcontext(sys.stdout) as fp:
+            header = dict(src=src, destinations=dest_map, limits=limits, copy=args.copy)
+            fp.write("# " + json.dumps(header) + "\n")
+            for full_path, final_path, ftype in find_typed_files(src, dest_map, args.walk_threads, sniffer, mapper):
+                try:
+                    size = os.stat(full_path).st_size
+                except OSError as e:
+                    logging.warning("Skipping %s: %s", full_path, e)
+                    continue
+                fp.write(json.dumps([action, size, ftype, full_path, final_path]) + "\n")
+                count += 1
+    finally:
+        if sniffer:
+            sniffer.close()
+        if mapper.dates:
+            mapper.dates.close()
+    return count
+
+
+def parse_line_range(spec: str | None) -> Tuple[int, float]:
+    """
+    Parse a 1-based, inclusive START:END range of plan entries. Either end can be left out.
+
+    >>> parse_line_range("101:200")
+    (101, 200)
+    >>> parse_line_range("5001:")
+    (5001, inf)
+    """
+    if not spec:
+        return 1, math.inf
+    start, sep, end = spec.partition(":")
+    if not sep:
+        raise ValueError(f"Expected START:END, got {spec!r}")
+    return int(start or 1), int(end) if end else math.inf
+
+
+def read_plan(path: str, lines: str | None = None) -> Tuple[dict, Iterator[Tuple[str, str, str, int]]]:
+    """
+    Open a plan written by write_plan, returning its header, and a generator of
+    tuple(origin_path, destination_path, type, size) for the entries in the lines range.
+    """
+    first, last = parse_line_range(lines)
+    fp = open(path)
+    header_line = fp.readline()
+    if not header_line.startswith("# "):
+        fp.close()
+        raise ValueError(f"{path} is not a plan file")
+    header = json.loads(header_line[2:])
+
+    def entries():
+        with fp:
+            for number, line in enumerate(fp, start=1):
+                if number < first:
+                    continue
+                if number > last:
+                    break
+                _, size, ftype, src, dst = json.loads(line)
+                yield src, dst, ftype, size
+
+    return header, entries()
+
+
+async def apply_plan(path: str, args: argparse.Namespace):
+    """Execute a plan written by write_plan with the parallel engine, without walking the source again"""
+    header, items = read_plan(path, args.lines)
+    if args.copy and not header["copy"]:
+        # Moving instead would delete the sources the user asked to keep
+        raise ValueError("the plan moves files, write it again with --copy to copy them")
+    args.copy = header["copy"]
+    logging.info("Applying %s: %s files from '%s' to %s", path, "copying" if args.copy else "moving", header["src"], header["destinations"])
+    await move_files(header["src"], header["destinations"], args, header["limits"], items)
+
+
+def replace_path(path: str, src: str, dst: str, resolve_symlinks: bool = False) -> str:
     """
     Replace the parent dir src in path with dst
 
     >>> replace_path("/Users/sandipb/a/b/c/nnnn/hello.txt", "/Users/sandipb/", "/usr/bin")
     '/usr/bin/a/b/c/nnnn/hello.txt'
+    >>> replace_path("/Users/sandipb/a/hello.txt", "/Users/sandipb", "/usr/bin")
+    '/usr/bin/a/hello.txt'
     """
+    if not resolve_symlinks:
+        prefix = os.path.join(src, "")
+        if path.startswith(prefix):
+            return os.path.join(dst, path[len(prefix) :])
     path = str(Path(path).resolve())
     src = str(Path(src).resolve())
     relative_path = str(Path(path).relative_to(src))
@@ -175,18 +1581,42 @@ def download_mt(url=EXTERNAL_MIMETYPE_SRC):
         sys.exit(1)
 
 
-def parse_destinations(dmap: List[str]) -> Dict[str, str]:
+def parse_destinations(dmap: List[str]) -> Tuple[Dict[str, str], Dict[str, int]]:
+    """
+    Parse TYPE=DIRECTORY[@LIMIT] specifiers into the type -> directory map, and the directory -> concurrency
+    limit map for the directories which have a limit.
+    """
     destinations: Dict[str, str] = dict()
+    limits: Dict[str, int] = dict()
     for entry in dmap:
         comps = entry.split("=", 1)
         if len(comps) != 2:
             logging.fatal("Invalid destination specifier: %s", entry)
             sys.exit(1)
         tname, tdest = [t.strip() for t in comps]
+        limit = None
+        path, sep, suffix = tdest.rpartition("@")
+        if sep and suffix.isdigit():
+            tdest, limit = path, int(suffix)
+            if limit < 1:
+                logging.fatal("Invalid concurrency limit in: %s", entry)
+                sys.exit(1)
+        template = ""
+        if "{" in tdest:
+            root = template_root(tdest)
+            template = tdest[len(root) :].lstrip("/")
+            tdest = root
+            try:
+                template.format(year="", month="", day="")
+            except (KeyError, IndexError, ValueError) as e:
+                logging.fatal("Invalid destination template in %s: %s", entry, e)
+                sys.exit(1)
         tdest = valid_dir_or_quit(tdest, f"Destination dir for {tname}")
-        destinations[tname.lower()] = tdest
+        destinations[tname.lower()] = os.path.join(tdest, template) if template else tdest
+        if limit is not None:
+            limits[tdest] = min(limit, limits.get(tdest, limit))
 
-    return destinations
+    return destinations, limits
 
 
 def valid_dir_or_quit(path: str, name: str) -> str:
@@ -201,16 +1631,51 @@ def valid_dir_or_quit(path: str, name: str) -> str:
     return rpath
 
 
-def main():
+def make_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser("mmm", description=DESCRIPTION, formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument("--verbose", "-v", action="store_true", help="List actions")
     parser.add_argument("--debug", "-d", action="store_true", help="Debug level logging")
     parser.add_argument("--mt-download", "-m", action="store_true", help="Download mime types reference")
     parser.add_argument("--dry-run", "-n", action="store_true", help="Dry run")
     parser.add_argument("--copy", "-c", action="store_true", help="Copy, don't move")
+    parser.add_argument(
+        "--verify", "-V", action="store_true", help="Checksum copies to other filesystems, and only remove moved files once verified"
+    )
+    parser.add_argument("--resume", "-r", action="store_true", help=f"Skip files already done as per {JOURNAL_FN} in destinations")
     parser.add_argument("--parallel", "-P", type=int, default=PARALLELISM, help="Number of parallel operations (default: %(default)d)")
-    parser.add_argument("src", metavar="SOURCE_DIR", help="Source directory")
-    parser.add_argument("dst", metavar="DST_PATTERN", nargs="+", help="Destination patterns in TYPE:DIRECTORY format")
+    parser.add_argument(
+        "--walk-threads", "-W", type=int, default=WALK_THREADS, help="Number of threads listing directories (default: %(default)d)"
+    )
+    parser.add_argument(
+        "--dedupe", "-D", action="store_true", help=f"Skip files already present with the same content. Hashes are kept in {HASH_INDEX_FN}"
+    )
+    parser.add_argument(
+        "--resolve-symlinks", action="store_true", help="Place symlinked files according to where their targets are under SOURCE_DIR"
+    )
+    parser.add_argument("--sniff", "-s", action="store_true", help="Detect the type of files with unknown extensions by content")
+    parser.add_argument("--watch", "-w", action="store_true", help="After moving existing files, keep moving new ones until interrupted")
+    parser.add_argument(
+        "--watch-debounce",
+        type=float,
+        default=WATCH_DEBOUNCE,
+        help="Seconds a new file must be left alone before it is moved in watch mode (default: %(default)s)",
+    )
+    parser.add_argument("--progress", "-p", action="store_true", help="Show a progress bar")
+    parser.add_argument(
+        "--stats-file",
+        metavar="PATH|FD",
+        help="Append a JSON line of throughput, queue depth and latency stats every second to a file, fd number or - for stdout",
+    )
+    parser.add_argument("--plan", metavar="PLAN_FILE", help="Write the files to move/copy to PLAN_FILE (- for stdout) instead")
+    parser.add_argument("--apply", metavar="PLAN_FILE", help="Move/copy the files in PLAN_FILE, instead of SOURCE_DIR")
+    parser.add_argument("--lines", metavar="START:END", help="Only apply entries START to END (1-based, inclusive) of the plan")
+    parser.add_argument("src", metavar="SOURCE_DIR", nargs="?", help="Source directory")
+    parser.add_argument("dst", metavar="DST_PATTERN", nargs="*", help="Destination patterns in TYPE=DIRECTORY format")
+    return parser
+
+
+def main():
+    parser = make_parser()
     args = parser.parse_args()
     log_level = logging.WARNING
     if args.verbose:
@@ -224,13 +1689,27 @@ def main():
         download_mt()
         sys.exit(0)
 
-    src = valid_dir_or_quit(args.src, "Source directory")
-    destinations = parse_destinations(args.dst)
-    logging.info("Moving files from '%s' using rules: %s", src, destinations)
+    if args.apply:
+        start = perf_counter()
+        try:
+            trio.run(apply_plan, args.apply, args)
+        except (OSError, ValueError) as e:
+            logging.fatal("Could not apply plan %s: %s", args.apply, e)
+            sys.exit(1)
+    else:
+        src = valid_dir_or_quit(args.src, "Source directory")
+        if not args.dst:
+            parser.error("at least one DST_PATTERN is required")
+        destinations, limits = parse_destinations(args.dst)
+        logging.info("Moving files from '%s' using rules: %s, concurrency limits: %s", src, destinations, limits)
 
-    init_mimetypes()
-    start = perf_counter()
-    trio.run(move_files, src, destinations, args)
+        init_mimetypes()
+        start = perf_counter()
+        if args.plan:
+            count = write_plan(src, destinations, limits, args, args.plan)
+            logging.info("Planned %d files in %s", count, args.plan)
+            return
+        trio.run(move_files, src, destinations, args, limits)
     elapsed = round(perf_counter() - start, 2)
     print(f"Operation completed in: {humanize.precisedelta(timedelta(seconds=elapsed))}")
     Metrics.stats()
@@ -0,0 +1,103 @@
+"""
+Benchmarks for imap_tools against the in-process IMAP server of tests.imap_server, with a simulated round trip time.
+
+Reports messages processed per second by stats-senders, stats and delete-matching for combinations of connections
+and batch sizes, and of commands pipelined on each connection. Each command is credited with the messages it
+processed: the unread ones for stats-senders, every one for stats, and the ones fetched for delete-matching, which are
+just the candidates found by the server with --server-search. Run from the top of the repository:
+
+  python -m tests.bench_imap_tools --messages 20000 --latency 0.02 --connections 1,4 --pipeline 1,8 --batch-size 100,500
+"""
+
+import argparse
+import itertools
+import os
+import re
+import tempfile
+from time import perf_counter
+from typing import Tuple
+
+from click.testing import CliRunner
+from prettytable import PrettyTable
+
+from everyday_scripts.imap_tools import cli
+from tests.imap_server import ImapServer
+
+
+def run(server: ImapServer, *args: str) -> Tuple[float, str]:
+    """Run an imap_tools command against the server, returning the seconds it took and its output"""
+    start = perf_counter()
+    result = CliRunner().invoke(cli, ["-s", server.url, "-u", "user", "-p", "pass", *args], catch_exceptions=False)
+    seconds = perf_counter() - start
+    if result.exit_code != 0:
+        raise SystemExit(f"imap_tools {' '.join(args)} failed:\n{result.output}")
+    return seconds, result.output
+
+
+def unseen(server: ImapServer) -> int:
+    return sum("\\Seen" not in msg.flags for msg in server.mailbox.messages)
+
+
+def processed(output: str) -> int:
+    """Number of emails a delete-matching run processed, from its summary"""
+    match = re.search(r"Total emails processed: (\d+)", output)
+    if match is None:
+        raise SystemExit(f"No summary in the output of delete-matching:\n{output}")
+    return int(match.group(1))
+
+
+def main():
+    parser = argparse.ArgumentParser("bench_imap_tools", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", "-m", type=int, default=5000, help="Number of messages in the mailbox (default: %(default)d)")
+    parser.add_argument(
+        "--latency", "-l", type=float, default=0.01, help="Seconds before the responses to every command arrive (default: %(default)s)"
+    )
+    parser.add_argument("--connections", "-c", default="1,4", help="Comma separated --connections values to run with")
+    parser.add_argument("--pipeline", "-P", default="1,8", help="Comma separated --pipeline values to run with")
+    parser.add_argument("--batch-size", "-b", default="100,500", help="Comma separated --batch-size values to run with")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="bench_imap_tools.") as workdir:
+        os.environ["XDG_CACHE_HOME"] = os.path.join(workdir, "cache")
+        patterns = os.path.join(workdir, "patterns.txt")
+        with open(patterns, "w") as f:
+            f.write("".join(f"domain{i}.example.com\n" for i in range(0, 50, 5)))
+        regex_patterns = os.path.join(workdir, "regex_patterns.txt")
+        with open(regex_patterns, "w") as f:
+            f.write("".join(f"@domain{i}\\.example\n" for i in range(0, 50, 5)))
+
+        table = PrettyTable(["Command", "Variant", "Messages", "Seconds", "Messages/s"])
+        table.align = "r"
+
+        def add(command: str, variant: str, messages: int, seconds: float):
+            table.add_row([command, variant, messages, f"{seconds:.3f}", f"{messages / seconds:,.0f}"])
+
+        for connections, pipeline, batch_size in itertools.product(
+            [int(c) for c in args.connections.split(",")],
+            [int(p) for p in args.pipeline.split(",")],
+            [int(b) for b in args.batch_size.split(",")],
+        ):
+            variant = f"connections={connections} pipeline={pipeline} batch-size={batch_size}"
+            common = ["--connections", str(connections), "--pipeline", str(pipeline)]
+            with ImapServer(args.messages, args.latency) as server:
+                seconds, _ = run(server, *common, "--no-cache", "stats-senders", "--batch-size", str(batch_size))
+                add("stats-senders", variant, unseen(server), seconds)
+                run(server, *common, "stats-senders", "--batch-size", str(batch_size))  # fill the header cache
+                seconds, _ = run(server, *common, "stats-senders", "--batch-size", str(batch_size))
+                add("stats-senders (cached)", variant, unseen(server), seconds)
+                seconds, _ = run(server, *common, "stats", "--batch-size", str(batch_size))
+                add("stats", variant, len(server.mailbox.messages), seconds)
+            for name, path, search in [
+                ("delete-matching", patterns, "--server-search"),
+                ("delete-matching (regex)", regex_patterns, "--no-server-search"),
+            ]:
+                with ImapServer(args.messages, args.latency) as server:
+                    delete = [name.split()[0], "-f", path, "--allow-all", "--no-progress", search]
+                    seconds, output = run(server, *common, "--no-cache", *delete, "--batch-size", str(batch_size))
+                    add(name, variant, processed(output), seconds)
+
+        print(table)
+
+
+if __name__ == "__main__":
+    main()
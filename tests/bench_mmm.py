@@ -0,0 +1,107 @@
+"""
+Benchmarks for the hot paths of mmm: walking, classifying, mapping destination paths and transferring files.
+
+Builds a synthetic source tree (in tmpfs when /dev/shm is available) and reports the throughput of every
+stage. Run from the top of the repository:
+
+  python -m tests.bench_mmm --files 100000 --shape deep --parallel 1,5,20
+"""
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+import trio
+from prettytable import PrettyTable
+
+from everyday_scripts import mmm
+
+EXTENSIONS = [".jpg", ".JPG", ".png", ".heic", ".mp4", ".MOV", ".xmp", ".txt", ""]
+# (size, weight): mostly photos, some short clips, a few large videos
+SIZES = [(4 * 1024, 80), (512 * 1024, 15), (8 * 1024 * 1024, 5)]
+
+
+def build_tree(root: Path, files: int, shape: str, scale: float) -> list[str]:
+    """Create files under root, spread over directories as per shape, and return their paths"""
+    rng = random.Random(42)
+    data = os.urandom(max(size for size, _ in SIZES))
+    sizes = [max(1, int(size * scale)) for size, _ in SIZES]
+    weights = [weight for _, weight in SIZES]
+    paths = []
+    for i in range(files):
+        if shape == "deep":
+            # 10 levels of binary fan-out
+            parts = [f"d{(i >> level) & 1}" for level in range(10)]
+        else:
+            parts = [f"d{i % 1000}"]
+        path = root.joinpath(*parts, f"f{i}{rng.choice(EXTENSIONS)}")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data[: rng.choices(sizes, weights)[0]])
+        paths.append(str(path))
+    return paths
+
+
+def timed(fn) -> float:
+    start = perf_counter()
+    fn()
+    return perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser("bench_mmm", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", "-f", type=int, default=10000, help="Number of files in the tree (default: %(default)d)")
+    parser.add_argument("--shape", choices=["deep", "wide"], default="wide", help="Shape of the tree (default: %(default)s)")
+    parser.add_argument("--size-scale", type=float, default=0.01, help="Scale for file sizes of 4K/512K/8M (default: %(default)s)")
+    parser.add_argument("--parallel", "-P", default="1,5,20", help="Comma separated --parallel values to transfer with")
+    parser.add_argument("--walk-threads", "-W", default="1,8", help="Comma separated --walk-threads values to walk with")
+    parser.add_argument("--dir", help="Directory to build the tree in (default: /dev/shm or the temp dir)")
+    args = parser.parse_args()
+
+    base = args.dir or ("/dev/shm" if os.path.isdir("/dev/shm") else None)
+    workdir = Path(tempfile.mkdtemp(prefix="bench_mmm.", dir=base))
+    os.environ.setdefault("XDG_CACHE_HOME", str(workdir / "cache"))
+    try:
+        src = workdir / "src"
+        start = perf_counter()
+        paths = build_tree(src, args.files, args.shape, args.size_scale)
+        print(f"Built {args.files} files ({args.shape}) in {workdir} in {perf_counter() - start:.1f}s")
+
+        mmm.init_mimetypes()
+        dest_map = {ftype: str(workdir / ftype) for ftype in ["image", "video"]}
+        names = [os.path.basename(p) for p in paths]
+        table = PrettyTable(["Stage", "Variant", "Items", "Seconds", "Items/s"])
+        table.align = "r"
+
+        def add(stage: str, variant: str, items: int, seconds: float):
+            table.add_row([stage, variant, items, f"{seconds:.3f}", f"{items / seconds:,.0f}"])
+
+        for threads in [int(t) for t in args.walk_threads.split(",")]:
+            found = []
+            seconds = timed(lambda: found.extend(mmm.find_files(str(src), dest_map, threads)))
+            add("find_files", f"walk-threads={threads}", len(found), seconds)
+
+        add("type_for_file", "", len(names), timed(lambda: [mmm.type_for_file(n) for n in names]))
+        for resolve in [False, True]:
+            seconds = timed(lambda: [mmm.replace_path(p, str(src), "/dst", resolve) for p in paths])
+            add("replace_path", f"resolve_symlinks={resolve}", len(paths), seconds)
+
+        for parallel in [int(p) for p in args.parallel.split(",")]:
+            for dst in dest_map.values():
+                shutil.rmtree(dst, ignore_errors=True)
+                os.makedirs(dst)
+            completed = mmm.Metrics.completed
+            ns = mmm.make_parser().parse_args(["--copy", "--parallel", str(parallel)])
+            seconds = timed(lambda: trio.run(mmm.move_files, str(src), dest_map, ns))
+            add("move_files --copy", f"parallel={parallel}", mmm.Metrics.completed - completed, seconds)
+
+        print(table)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
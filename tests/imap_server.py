@@ -0,0 +1,289 @@
+"""
+An in-process IMAP server speaking just enough of the protocol for imap_tools, for tests and benchmarks without
+network access.
+
+Its single mailbox is seeded with synthetic messages, and every command can be delayed to stand in for the round trip
+to a real server. With reorder, pipelined commands complete out of order, like on servers that process them
+concurrently:
+
+  with ImapServer(messages=10000, latency=0.02) as server:
+      cli(["-s", server.url, "-u", "user", "-p", "pass", "stats-senders"])
+"""
+
+import bisect
+import queue
+import random
+import re
+import socketserver
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+CAPABILITIES = "IMAP4rev1 UIDPLUS"
+UIDVALIDITY = 1
+TOKEN_RE = re.compile(r'"[^"]*"|\(|\)|[^\s()]+')
+FIELDS_RE = re.compile(r"BODY\.PEEK\[HEADER\.FIELDS \(([^)]*)\)\]", re.IGNORECASE)
+
+
+@dataclass
+class Message:
+    uid: int
+    sender: str
+    subject: str
+    date: datetime
+    list_id: Optional[str] = None
+    size: int = 4096
+    flags: Set[str] = field(default_factory=set)
+
+    def headers(self) -> Dict[str, str]:
+        headers = {"FROM": self.sender, "SUBJECT": self.subject}
+        if self.list_id:
+            headers["LIST-ID"] = self.list_id
+        return headers
+
+    def header_fields(self, names: List[str]) -> bytes:
+        names = [name.upper() for name in names]
+        headers = self.headers()
+        lines = [f"{name.title()}: {headers[name]}\r\n" for name in names if name in headers]
+        return ("".join(lines) + "\r\n").encode()
+
+
+def synthetic_messages(count: int, seed: int = 42, senders: int = 200, unseen: float = 0.7) -> List[Message]:
+    """Messages from a pool of senders, a few of them mailing lists, spread over the last two years"""
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    messages = []
+    for uid in range(1, count + 1):
+        sender = rng.randrange(senders)
+        messages.append(
+            Message(
+                uid=uid,
+                sender=f"Sender {sender} <user{sender}@domain{sender % 50}.example.com>",
+                subject=f"Message {uid}",
+                date=start + timedelta(days=730 * uid / count),
+                list_id=f"List {sender} <list{sender}.example.com>" if sender % 10 == 0 else None,
+                size=rng.choice([2048, 16384, 262144]),
+                flags=set() if rng.random() < unseen else {"\\Seen"},
+            )
+        )
+    return messages
+
+
+class Mailbox:
+    """The messages of the server, shared by all connections"""
+
+    def __init__(self, messages: List[Message]):
+        self.messages = messages
+        self.lock = threading.Lock()
+
+    def by_uids(self, message_set: str) -> Iterator[Tuple[int, Message]]:
+        """(sequence number, message) for the messages in a UID message set"""
+        last = self.messages[-1].uid if self.messages else 0
+        ranges = []
+        for part in message_set.split(","):
+            start, _, end = part.partition(":")
+            low, high = int(start.replace("*", str(last))), int((end or start).replace("*", str(last)))
+            ranges.append((min(low, high), max(low, high)))
+        uids = [msg.uid for msg in self.messages]
+        for low, high in sorted(ranges):
+            # Messages are in UID order
+            for idx in range(bisect.bisect_left(uids, low), bisect.bisect_right(uids, high)):
+                yield idx + 1, self.messages[idx]
+
+    def search(self, tokens: List[str]) -> List[int]:
+        keys = list(tokens)
+        criteria = []
+        while keys:
+            criteria.append(parse_search_key(keys))
+        return [msg.uid for msg in self.messages if all(criterion(msg) for criterion in criteria)]
+
+    def expunge(self, uids: Optional[Set[int]] = None) -> List[int]:
+        """Remove deleted messages, returning the sequence numbers of the EXPUNGE responses"""
+        expunged = []
+        seq = 1
+        for msg in list(self.messages):
+            if "\\Deleted" in msg.flags and (uids is None or msg.uid in uids):
+                self.messages.remove(msg)
+                expunged.append(seq)
+            else:
+                seq += 1
+        return expunged
+
+
+def unquote(token: str) -> str:
+    return token[1:-1] if token.startswith('"') else token
+
+
+def parse_search_key(tokens: List[str]):
+    """Pop one search key off tokens and return a predicate for it"""
+    key = tokens.pop(0).upper()
+    if key == "ALL":
+        return lambda msg: True
+    if key in ("SEEN", "UNSEEN", "DELETED", "UNDELETED"):
+        flag = "\\" + key.removeprefix("UN").title()
+        return (lambda msg: flag not in msg.flags) if key.startswith("UN") else (lambda msg: flag in msg.flags)
+    if key == "FROM":
+        value = unquote(tokens.pop(0)).lower()
+        return lambda msg: value in msg.sender.lower()
+    if key == "OR":
+        left, right = parse_search_key(tokens), parse_search_key(tokens)
+        return lambda msg: left(msg) or right(msg)
+    raise ValueError(f"Unsupported search key {key}")
+
+
+class ImapHandler(socketserver.StreamRequestHandler):
+    """
+    Executes commands in order as soon as they arrive, and sends the responses to each command after the latency.
+
+    Like a real round trip, the latency delays the responses but not the processing of pipelined commands. With
+    reorder, the responses to the commands waiting to be sent together go out last command first.
+    """
+
+    server: "ImapServer"
+
+    def setup(self):
+        super().setup()
+        self.output: List[bytes] = []
+        self.responses: queue.Queue[Tuple[float, bytes] | None] = queue.Queue()
+        self.writer = threading.Thread(target=self.write_responses, daemon=True)
+        self.writer.start()
+
+    def finish(self):
+        self.responses.put(None)
+        self.writer.join()
+        super().finish()
+
+    def write_responses(self):
+        while (response := self.responses.get()) is not None:
+            due, data = response
+            time.sleep(max(0.0, due - time.monotonic()))
+            batch = [data]
+            while self.server.reorder and response is not None:
+                try:
+                    response = self.responses.get_nowait()
+                except queue.Empty:
+                    break
+                if response is not None:
+                    batch.insert(0, response[1])
+            try:
+                self.wfile.write(b"".join(batch))
+                self.wfile.flush()
+            except OSError:
+                return
+            if response is None:
+                return
+
+    def send(self, line: str | bytes):
+        self.output.append(line if isinstance(line, bytes) else line.encode() + b"\r\n")
+
+    def respond(self, received: float):
+        self.responses.put((received + self.server.latency, b"".join(self.output)))
+        self.output = []
+
+    def handle(self):
+        self.send(f"* OK [CAPABILITY {CAPABILITIES}] Test server ready")
+        self.respond(time.monotonic())
+        for raw in self.rfile:
+            received = time.monotonic()
+            tag, _, rest = raw.decode().rstrip("\r\n").partition(" ")
+            command, _, args = rest.partition(" ")
+            command = command.upper()
+            if command == "UID":
+                command, _, args = args.partition(" ")
+                command = "UID " + command.upper()
+            if command == "LOGOUT":
+                self.send("* BYE Logging out")
+                self.send(f"{tag} OK LOGOUT completed")
+                self.respond(received)
+                return
+            try:
+                with self.server.mailbox.lock:
+                    result = self.dispatch(command, args)
+            except (ValueError, IndexError, KeyError) as e:
+                self.send(f"{tag} BAD {e}")
+            else:
+                self.send(f"{tag} {result}")
+            self.respond(received)
+
+    def dispatch(self, command: str, args: str) -> str:
+        mailbox = self.server.mailbox
+        if command in ("CAPABILITY",):
+            self.send(f"* CAPABILITY {CAPABILITIES}")
+        elif command in ("LOGIN", "NOOP", "CLOSE"):
+            pass
+        elif command == "LIST":
+            self.send('* LIST (\\HasNoChildren) "/" "INBOX"')
+        elif command in ("SELECT", "EXAMINE"):
+            if unquote(args).upper() != "INBOX":
+                return "NO No such mailbox"
+            self.send(f"* {len(mailbox.messages)} EXISTS")
+            self.send(f"* OK [UIDVALIDITY {UIDVALIDITY}] UIDs valid")
+            return f"OK [{'READ-ONLY' if command == 'EXAMINE' else 'READ-WRITE'}] {command} completed"
+        elif command == "UID SEARCH":
+            tokens = TOKEN_RE.findall(args)
+            if tokens and tokens[0].upper() == "CHARSET":
+                tokens = tokens[2:]
+            self.send(" ".join(["* SEARCH", *(str(uid) for uid in mailbox.search(tokens))]))
+        elif command == "UID FETCH":
+            message_set, _, items = args.partition(" ")
+            self.fetch(message_set, items)
+        elif command == "UID STORE":
+            message_set, operation, flags = args.split(" ", 2)
+            for _, msg in mailbox.by_uids(message_set):
+                if operation.upper().startswith("+FLAGS"):
+                    msg.flags.update(flags.strip("()").split())
+                else:
+                    msg.flags.difference_update(flags.strip("()").split())
+        elif command == "UID EXPUNGE":
+            uids = {msg.uid for _, msg in mailbox.by_uids(args)}
+            for seq in mailbox.expunge(uids):
+                self.send(f"* {seq} EXPUNGE")
+        elif command == "EXPUNGE":
+            for seq in mailbox.expunge():
+                self.send(f"* {seq} EXPUNGE")
+        else:
+            return f"BAD Unsupported command {command}"
+        return f"OK {command} completed"
+
+    def fetch(self, message_set: str, items: str):
+        fields = FIELDS_RE.search(items)
+        for seq, msg in self.server.mailbox.by_uids(message_set):
+            parts = [f"UID {msg.uid}"]
+            if "RFC822.SIZE" in items.upper():
+                parts.append(f"RFC822.SIZE {msg.size}")
+            if "INTERNALDATE" in items.upper():
+                parts.append(f'INTERNALDATE "{msg.date.strftime("%d-%b-%Y %H:%M:%S %z")}"')
+            if fields:
+                header = msg.header_fields(fields.group(1).split())
+                parts.append(f"BODY[HEADER.FIELDS ({fields.group(1).upper()})] {{{len(header)}}}")
+                self.send(f"* {seq} FETCH ({' '.join(parts)}".encode() + b"\r\n" + header + b")\r\n")
+            else:
+                self.send(f"* {seq} FETCH ({' '.join(parts)})")
+
+
+class ImapServer(socketserver.ThreadingTCPServer):
+    """The server, listening on a free port of localhost while used as a context manager"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, messages: int | List[Message] = 1000, latency: float = 0.0, reorder: bool = False):
+        super().__init__(("127.0.0.1", 0), ImapHandler)
+        self.mailbox = Mailbox(synthetic_messages(messages) if isinstance(messages, int) else messages)
+        self.latency = latency
+        self.reorder = reorder
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"imap://{host}:{port}"
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
@@ -1,11 +1,36 @@
-from everyday_scripts.mmm import find_files
+from everyday_scripts import mmm
+from everyday_scripts.mmm import JOURNAL_FN, Metrics, fast_copyfile, find_files, move_files
 import pytest
 from pathlib import Path
 import itertools
 import os
 from pprint import pprint
+import argparse
+import json
+import shutil
+import struct
+from datetime import datetime
+import sys
+import trio
 
-def test_find_files(tmp_path):
+def make_args(**options) -> argparse.Namespace:
+    """Options as mmm parses them from an empty command line, with the given ones set"""
+    args = mmm.make_parser().parse_args([])
+    for name, value in options.items():
+        assert hasattr(args, name), f"mmm has no option {name}"
+        setattr(args, name, value)
+    return args
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path, monkeypatch):
+    cache = tmp_path / "cache"
+    monkeypatch.setenv("XDG_CACHE_HOME", str(cache))
+    return cache
+
+
+@pytest.mark.parametrize("walk_threads", [1, 4])
+def test_find_files(tmp_path, walk_threads):
     src: Path = tmp_path / "pictures"
     images: Path = tmp_path / "images"
     videos: Path = tmp_path / "videos"
@@ -38,8 +63,459 @@ def test_find_files(tmp_path):
     all_outs.sort()
     dmap = {"image": str(images), "video": str(videos)}
     got = [
-        d for s, d in find_files(str(src), dest_map=dmap)
+        d for s, d in find_files(str(src), dest_map=dmap, walk_threads=walk_threads)
     ]
     got.sort()
 
     assert all_outs == got
+
+
+@pytest.mark.parametrize("copy", [False, True])
+def test_move_files(tmp_path, copy):
+    src: Path = tmp_path / "pictures"
+    images: Path = tmp_path / "images"
+    images.mkdir()
+    names = [f"d{i % 7}/{i}.jpg" for i in range(50)]
+    for name in names:
+        f: Path = src / name
+        f.parent.mkdir(parents=True, exist_ok=True)
+        f.write_text(name)
+        os.utime(f, ns=(1_500_000_000_000_000_000, 1_600_000_000_000_000_000))
+
+    args = make_args(copy=copy, dry_run=False, parallel=3)
+    trio.run(move_files, str(src), {"image": str(images)}, args)
+
+    for name in names:
+        assert (images / name).read_text() == name
+        assert (src / name).exists() == copy
+        # Copies keep the mtime, so that a later --copy --dedupe recognizes them without hashing
+        assert os.stat(images / name).st_mtime_ns == 1_600_000_000_000_000_000
+
+
+def test_fast_copyfile(tmp_path):
+    src: Path = tmp_path / "src.bin"
+    dst: Path = tmp_path / "dst.bin"
+    data = os.urandom(3 * 1024 * 1024 + 7)
+    src.write_bytes(data)
+    fast_copyfile(str(src), str(dst))
+    assert dst.read_bytes() == data
+    with pytest.raises(shutil.SameFileError):
+        fast_copyfile(str(src), str(src))
+    assert src.read_bytes() == data
+
+
+def test_move_files_resume(tmp_path):
+    src: Path = tmp_path / "pictures"
+    images: Path = tmp_path / "images"
+    images.mkdir()
+    for i in range(10):
+        f: Path = src / f"{i}.jpg"
+        f.parent.mkdir(parents=True, exist_ok=True)
+        f.write_text(str(i))
+
+    args = make_args(copy=True, dry_run=False, parallel=2, resume=False)
+    trio.run(move_files, str(src), {"image": str(images)}, args)
+    assert (images / JOURNAL_FN).exists()
+
+    # Files recorded in the journal are not copied again, changed ones are
+    (images / "1.jpg").unlink()
+    (images / "2.jpg").unlink()
+    (src / "2.jpg").write_text("changed")
+    skipped = Metrics.skipped
+    args.resume = True
+    trio.run(move_files, str(src), {"image": str(images)}, args)
+    assert Metrics.skipped - skipped == 9
+    assert not (images / "1.jpg").exists()
+    assert (images / "2.jpg").read_text() == "changed"
+
+
+def test_journal_appends(tmp_path):
+    path = tmp_path / JOURNAL_FN
+    st = os.stat(tmp_path)
+    journal = mmm.Journal(str(path))
+    journal.record("copy", "a", "b", "image", st)
+    journal.close()
+    with open(path, "a") as fp:
+        fp.write('{"action": "cop')  # Crashed mid-write
+
+    # Reopening without --resume keeps the earlier entries, and starts a new line after the partial one
+    journal = mmm.Journal(str(path))
+    journal.record("copy", "c", "d", "image", st)
+    journal.close()
+    journal = mmm.Journal(str(path))
+    journal.record("copy", "c", "d", "image", st)  # Copied again by a later run
+    journal.close()
+    copies = Metrics.copies
+    journal = mmm.Journal(str(path), resume=True)
+    journal.close()
+    assert sorted(journal.done) == ["a", "c"]
+    assert journal.is_done("c", "d", st)
+    assert Metrics.copies - copies == 2
+
+
+def test_init_mimetypes_cache(cache_home):
+    table = mmm.init_mimetypes()
+    assert table[".jpg"] == "image"
+    assert table[".mov"] == "video"
+    assert table[".xmp"] == "image"
+    assert (cache_home / "mmm" / mmm.EXT_TYPES_CACHE_FN).exists()
+
+    mmm.EXT_TYPES.clear()
+    assert mmm.init_mimetypes() == table
+    assert mmm.type_for_file("a/b/C.JPG") == "image"
+    assert mmm.type_for_file("a/b/noext") is None
+
+
+@pytest.mark.parametrize("threads", [1, 3])
+def test_walk_tree(tmp_path, threads):
+    (tmp_path / "a" / "b").mkdir(parents=True)
+    (tmp_path / "a" / "b" / "f1").write_text("")
+    (tmp_path / "f2").write_text("")
+    (tmp_path / "link").symlink_to(tmp_path / "a")
+    got = {(os.path.relpath(d, tmp_path), tuple(sorted(f))) for d, f in mmm.walk_tree(str(tmp_path), threads)}
+    assert got == {(".", ("f2",)), ("a", ()), ("a/b", ("f1",))}
+
+
+def test_sniffer(tmp_path, cache_home):
+    photo: Path = tmp_path / "IMG_0001"
+    photo.write_bytes(b"\xff\xd8\xff\xe0" + bytes(100))
+    st = photo.stat()
+    sniffer = mmm.Sniffer(mmm.SqliteCache(str(cache_home / "sniff.sqlite")))
+    assert sniffer(str(photo)) == "image"
+
+    # Same size and mtime: served from the cache without reading the file
+    photo.write_bytes(b"fLaC" + bytes(100))
+    os.utime(photo, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert sniffer(str(photo)) == "image"
+    sniffer.close()
+
+
+def test_find_files_sniff(tmp_path):
+    src: Path = tmp_path / "pictures"
+    src.mkdir()
+    (src / "IMG_0001").write_bytes(b"\x00\x00\x00\x18ftypheic" + bytes(100))
+    (src / "CLIP_0001").write_bytes(b"\x00\x00\x00\x18ftypisom" + bytes(100))
+    (src / "notes").write_text("hello")
+    dmap = {"image": "/images", "video": "/videos"}
+    assert list(find_files(str(src), dmap)) == []
+    got = sorted(d for _, d, _ in mmm.find_typed_files(str(src), dmap, sniffer=mmm.Sniffer()))
+    assert got == ["/images/IMG_0001", "/videos/CLIP_0001"]
+
+
+@pytest.mark.parametrize("copy", [False, True])
+def test_move_files_dedupe(tmp_path, copy):
+    src: Path = tmp_path / "pictures"
+    images: Path = tmp_path / "images"
+    src.mkdir()
+    images.mkdir()
+    big = os.urandom(300 * 1024)
+    contents = {
+        "same.jpg": (b"same", b"same"),
+        "big.jpg": (big, big),
+        "differs.jpg": (b"new!", b"old!"),
+        "bigdiffers.jpg": (big, big[:-1] + b"x"),
+    }
+    for name, (new, old) in contents.items():
+        (src / name).write_bytes(new)
+        (images / name).write_bytes(old)
+        os.utime(images / name, ns=(0, 0))
+    # Same size and mtime, but a different content
+    (src / "touched.jpg").write_bytes(b"new!")
+    (images / "touched.jpg").write_bytes(b"old!")
+    os.utime(src / "touched.jpg", ns=(0, 0))
+    os.utime(images / "touched.jpg", ns=(0, 0))
+
+    duplicates = Metrics.duplicates
+    args = make_args(copy=copy, dry_run=False, parallel=2, dedupe=True)
+    trio.run(move_files, str(src), {"image": str(images)}, args)
+
+    assert (images / mmm.HASH_INDEX_FN).exists()
+    for name, (new, _) in contents.items():
+        assert (images / name).read_bytes() == new
+        assert (src / name).exists() == copy
+    # Copies trust the mtime, but moves only delete a source with the same content
+    assert Metrics.duplicates - duplicates == (3 if copy else 2)
+    assert (images / "touched.jpg").read_bytes() == (b"old!" if copy else b"new!")
+    assert (src / "touched.jpg").exists() == copy
+
+
+def test_find_files_symlinks(tmp_path):
+    src: Path = tmp_path / "pictures"
+    (src / "a").mkdir(parents=True)
+    (src / "b").mkdir()
+    (src / "a" / "1.jpg").write_text("")
+    (src / "b" / "link.jpg").symlink_to(src / "a" / "1.jpg")
+    (tmp_path / "outside.jpg").write_text("")
+    (src / "b" / "outside.jpg").symlink_to(tmp_path / "outside.jpg")
+    dmap = {"image": "/images"}
+
+    got = sorted(d for _, d in find_files(str(src), dmap))
+    assert got == ["/images/a/1.jpg", "/images/b/link.jpg", "/images/b/outside.jpg"]
+
+    mapper = mmm.PathMapper(str(src), dmap, resolve_symlinks=True)
+    got = sorted(d for _, d, _ in mmm.find_typed_files(str(src), dmap, mapper=mapper))
+    assert got == ["/images/a/1.jpg", "/images/a/1.jpg"]
+
+
+def test_move_files_stats_file(tmp_path):
+    src: Path = tmp_path / "pictures"
+    images: Path = tmp_path / "images"
+    src.mkdir()
+    images.mkdir()
+    for i in range(20):
+        (src / f"{i}.jpg").write_bytes(bytes(100))
+    stats_file: Path = tmp_path / "stats.jsonl"
+
+    completed = Metrics.completed
+    args = make_args(copy=True, dry_run=False, parallel=4, stats_file=str(stats_file))
+    trio.run(move_files, str(src), {"image": str(images)}, args)
+
+    last = json.loads(stats_file.read_text().splitlines()[-1])
+    assert last["files"] - completed == 20
+    assert last["in_flight"] == 0
+    assert sum(last["latency_ms"]["copy"].values()) >= 20
+
+
+def test_open_stats_stream_fd():
+    read_fd, write_fd = os.pipe()
+    try:
+        stream = mmm.open_stats_stream(str(write_fd))
+        stream.write("{}\n")
+        stream.close()
+        # The caller's descriptor is left open
+        os.fstat(write_fd)
+        assert os.read(read_fd, 10) == b"{}\n"
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+def test_transfer_queue_interleaves():
+    async def run():
+        queue = mmm.TransferQueue(capacity=10, workers=2)
+        for name, large in [("L1", True), ("L2", True), ("S1", False), ("S2", False)]:
+            await queue.put(name, large)
+        await queue.close()
+        got = [await queue.get() for _ in range(3)]
+        # Only one large file at a time with two workers
+        assert got == [("S1", False), ("L1", True), ("S2", False)]
+        await queue.done_large()
+        assert await queue.get() == ("L2", True)
+        assert await queue.get() is None
+
+    trio.run(run)
+
+
+def test_parse_destinations(tmp_path):
+    (tmp_path / "ssd").mkdir()
+    (tmp_path / "nas").mkdir()
+    destinations, limits = mmm.parse_destinations([f"image={tmp_path}/ssd", f"video={tmp_path}/nas@2", f"audio={tmp_path}/nas@3"])
+    assert destinations == {"image": f"{tmp_path}/ssd", "video": f"{tmp_path}/nas", "audio": f"{tmp_path}/nas"}
+    assert limits == {f"{tmp_path}/nas": 2}
+
+
+def test_verified_move(tmp_path):
+    src: Path = tmp_path / "src.mov"
+    dst: Path = tmp_path / "dst.mov"
+    data = os.urandom(mmm.COPY_BUFFER_SIZE * 2 + 13)
+    src.write_bytes(data)
+    os.utime(src, ns=(0, 10**18))
+    mmm.verified_move(str(src), str(dst))
+    assert not src.exists()
+    assert dst.read_bytes() == data
+    assert dst.stat().st_mtime_ns == 10**18
+
+
+def test_verified_move_mismatch(tmp_path, monkeypatch):
+    src: Path = tmp_path / "src.mov"
+    src.write_bytes(b"data")
+    monkeypatch.setattr(mmm, "hash_file", lambda fp, buf: "corrupt")
+    with pytest.raises(OSError):
+        mmm.verified_move(str(src), str(tmp_path / "dst.mov"))
+    assert src.read_bytes() == b"data"
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux only")
+def test_move_files_watch(tmp_path):
+    src: Path = tmp_path / "pictures"
+    images: Path = tmp_path / "images"
+    src.mkdir()
+    images.mkdir()
+    (src / "old.jpg").write_text("old")
+
+    async def run():
+        args = make_args(copy=False, dry_run=False, parallel=2, watch=True, watch_debounce=0.1)
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(move_files, str(src), {"image": str(images)}, args)
+            await trio.sleep(0.3)
+            assert (images / "old.jpg").exists()
+            (src / "new.jpg").write_text("new")
+            (src / "sub").mkdir()
+            (src / "sub" / "deep.jpg").write_text("deep")
+            with trio.move_on_after(5):
+                while not ((images / "new.jpg").exists() and (images / "sub" / "deep.jpg").exists()):
+                    await trio.sleep(0.05)
+            nursery.cancel_scope.cancel()
+
+    trio.run(run)
+    assert (images / "new.jpg").read_text() == "new"
+    assert (images / "sub" / "deep.jpg").read_text() == "deep"
+    assert not (src / "new.jpg").exists()
+
+
+def exif_jpeg(date: bytes) -> bytes:
+    """Minimal JPEG with an EXIF DateTimeOriginal"""
+    tiff = b"II*\x00" + struct.pack("<I", 8)
+    tiff += struct.pack("<HHHII", 1, 0x8769, 4, 1, 26) + struct.pack("<I", 0)  # IFD0 -> EXIF IFD at 26
+    tiff += struct.pack("<HHHII", 1, 0x9003, 2, len(date) + 1, 44) + struct.pack("<I", 0)  # value at 44
+    tiff += date + b"\x00"
+    app1 = b"Exif\x00\x00" + tiff
+    return b"\xff\xd8" + b"\xff\xe0" + struct.pack(">H", 4) + b"JF" + b"\xff\xe1" + struct.pack(">H", len(app1) + 2) + app1 + b"\xff\xd9"
+
+
+def mp4(created: int) -> bytes:
+    """Minimal MP4 with a version 0 movie header"""
+    ftyp = struct.pack(">I4s", 16, b"ftyp") + b"isom\x00\x00\x02\x00"
+    mdat = struct.pack(">I4s", 12, b"mdat") + bytes(4)
+    mvhd = struct.pack(">I4s", 20, b"mvhd") + bytes(4) + struct.pack(">II", created + mmm.MP4_EPOCH_OFFSET, 0)
+    moov = struct.pack(">I4s", 8 + len(mvhd), b"moov") + mvhd
+    return ftyp + mdat + moov
+
+
+def test_media_date(tmp_path, cache_home):
+    photo: Path = tmp_path / "IMG_0001.JPG"
+    photo.write_bytes(exif_jpeg(b"2021:07:04 10:11:12"))
+    clip: Path = tmp_path / "CLIP.MP4"
+    clip_time = int(datetime(2019, 12, 31, 23, 0).timestamp())
+    clip.write_bytes(mp4(clip_time))
+    other: Path = tmp_path / "other.png"
+    other.write_bytes(b"\x89PNG\r\n\x1a\n")
+    os.utime(other, (0, 1_600_000_000))
+
+    cache = mmm.SqliteCache(str(cache_home / "dates.sqlite"))
+    assert mmm.media_date(str(photo), cache) == datetime(2021, 7, 4, 10, 11, 12)
+    assert mmm.media_date(str(photo), cache) == datetime(2021, 7, 4, 10, 11, 12)
+    assert mmm.media_date(str(clip)) == datetime(2019, 12, 31, 23, 0)
+    assert mmm.media_date(str(other)) == datetime.fromtimestamp(1_600_000_000)
+    cache.close()
+
+
+def test_media_date_corrupt(tmp_path):
+    photo: Path = tmp_path / "IMG_0001.JPG"
+    # DateTimeOriginal claiming to be 2 GiB long
+    entry = struct.pack("<HHI", 0x9003, 2, 20)
+    photo.write_bytes(exif_jpeg(b"2021:07:04 10:11:12").replace(entry, struct.pack("<HHI", 0x9003, 2, 0x7FFFFFF0)))
+    clip: Path = tmp_path / "CLIP.MP4"
+    # Version 1 movie header with a creation time in the year 11410
+    mvhd = struct.pack(">I4s", 20, b"mvhd") + b"\x01" + bytes(3) + struct.pack(">Q", 300_000_000_000)
+    clip.write_bytes(mp4(0)[:16] + struct.pack(">I4s", 8 + len(mvhd), b"moov") + mvhd)
+    for path in (photo, clip):
+        os.utime(path, (0, 1_600_000_000))
+        assert mmm.media_date(str(path)) == datetime.fromtimestamp(1_600_000_000)
+
+    # Files removed during the walk are skipped
+    destinations = {"image": f"{tmp_path}/{{year}}"}
+    mapper = mmm.PathMapper(str(tmp_path), destinations)
+    assert mmm.classify_file(str(tmp_path / "gone.jpg"), destinations, mapper) is None
+
+
+def test_find_files_template(tmp_path):
+    src: Path = tmp_path / "pictures"
+    photos: Path = tmp_path / "photos"
+    (src / "a").mkdir(parents=True)
+    photos.mkdir()
+    (src / "a" / "IMG_0001.JPG").write_bytes(exif_jpeg(b"2021:07:04 10:11:12"))
+    destinations, _ = mmm.parse_destinations([f"image={photos}/{{year}}/{{month}}"])
+    assert destinations == {"image": f"{photos}/{{year}}/{{month}}"}
+    assert [d for _, d in find_files(str(src), destinations)] == [f"{photos}/2021/07/IMG_0001.JPG"]
+
+
+@pytest.mark.parametrize("copy", [True, False])
+def test_move_files_template_collisions(tmp_path, copy):
+    src: Path = tmp_path / "pictures"
+    photos: Path = tmp_path / "photos"
+    for camera in ("a", "b", "c"):
+        (src / camera).mkdir(parents=True)
+    photos.mkdir()
+    # Same name and date from two cameras, and a copy of the first one
+    (src / "a" / "IMG_0001.JPG").write_bytes(exif_jpeg(b"2021:07:04 10:11:12") + b"a")
+    (src / "b" / "IMG_0001.JPG").write_bytes(exif_jpeg(b"2021:07:20 08:00:00") + b"b")
+    (src / "c" / "IMG_0001.JPG").write_bytes(exif_jpeg(b"2021:07:04 10:11:12") + b"a")
+
+    destinations = {"image": f"{photos}/{{year}}/{{month}}"}
+    duplicates = Metrics.duplicates
+    trio.run(move_files, str(src), destinations, make_args(copy=copy, parallel=1))
+    got = sorted(p.read_bytes()[-1:] for p in (photos / "2021" / "07").iterdir())
+    assert sorted(p.name for p in (photos / "2021" / "07").iterdir()) == ["IMG_0001-1.JPG", "IMG_0001.JPG"]
+    assert got == [b"a", b"b"]
+    assert Metrics.duplicates - duplicates == 1
+    assert len(list(src.rglob("*.JPG"))) == (3 if copy else 0)
+
+    # Copying again finds every file already there
+    if copy:
+        trio.run(move_files, str(src), destinations, make_args(copy=True, parallel=1))
+        assert Metrics.duplicates - duplicates == 4
+        assert len(list((photos / "2021" / "07").iterdir())) == 2
+
+
+def test_dir_cache(tmp_path, monkeypatch):
+    (tmp_path / "a").mkdir()
+    calls = []
+    makedirs = os.makedirs
+    monkeypatch.setattr(mmm.os, "makedirs", lambda path, exist_ok: calls.append(path) or makedirs(path, exist_ok=exist_ok))
+    dirs = mmm.DirCache()
+    for _ in range(3):
+        dirs.ensure(str(tmp_path / "a" / "b"))
+        dirs.ensure(str(tmp_path / "a" / "c"))
+    assert calls == [str(tmp_path / "a" / "b"), str(tmp_path / "a" / "c")]
+    assert (tmp_path / "a" / "b").is_dir()
+
+
+def test_plan_apply(tmp_path):
+    src: Path = tmp_path / "pictures"
+    images: Path = tmp_path / "images"
+    src.mkdir()
+    images.mkdir()
+    for i in range(10):
+        (src / f"{i}.jpg").write_text(str(i))
+    plan: Path = tmp_path / "plan"
+
+    args = make_args(copy=True, dry_run=False, parallel=2)
+    assert mmm.write_plan(str(src), {"image": str(images)}, {}, args, str(plan)) == 10
+    assert not list(images.glob("*.jpg"))
+    entries = [json.loads(line) for line in plan.read_text().splitlines()[1:]]
+    assert sorted(e[3] for e in entries) == sorted(str(p) for p in src.glob("*.jpg"))
+
+    # A plan of moves is not applied when asked to copy
+    moves: Path = tmp_path / "moves"
+    mmm.write_plan(str(src), {"image": str(images)}, {}, make_args(), str(moves))
+    with pytest.raises(ValueError):
+        trio.run(mmm.apply_plan, str(moves), make_args(apply=str(moves), copy=True))
+    assert len(list(src.glob("*.jpg"))) == 10
+
+    # Apply in two shards
+    for lines in ["1:4", "5:"]:
+        trio.run(mmm.apply_plan, str(plan), make_args(copy=False, dry_run=False, parallel=2, lines=lines))
+        copied = {os.path.basename(e[4]) for e in entries[: 4 if lines == "1:4" else 10]}
+        assert {p.name for p in images.glob("*.jpg")} == copied
+    assert len(list(src.glob("*.jpg"))) == 10
+
+
+def test_plan_apply_shards_resume(tmp_path):
+    src: Path = tmp_path / "pictures"
+    images: Path = tmp_path / "images"
+    src.mkdir()
+    images.mkdir()
+    for i in range(4):
+        (src / f"{i}.jpg").write_text(str(i))
+    plan: Path = tmp_path / "plan"
+    assert mmm.write_plan(str(src), {"image": str(images)}, {}, make_args(copy=True), str(plan)) == 4
+
+    # Every shard adds to the journal of the destination instead of replacing it
+    for lines in ["1:2", "3:4"]:
+        trio.run(mmm.apply_plan, str(plan), make_args(apply=str(plan), lines=lines))
+    assert len((images / JOURNAL_FN).read_text().splitlines()) == 4
+
+    skipped = Metrics.skipped
+    trio.run(mmm.apply_plan, str(plan), make_args(apply=str(plan), resume=True))
+    assert Metrics.skipped - skipped == 4